@@ -0,0 +1,92 @@
+"""
+Small in-process caches shared by the API endpoints and DB helpers
+"""
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Bounded mapping whose entries expire after `ttl` seconds.
+
+    The least recently used entry is evicted once `maxsize` is reached.
+    Access is guarded by a lock because sync routes run concurrently in
+    the worker threadpool.
+
+    Removing a key bumps its generation. A cache-aside reader takes
+    generation(key) before its query and passes it to set(), which then
+    drops the value if the key was invalidated while the query ran.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        # Per-key invalidation counts, plus an epoch that clear() and pruning bump
+        self._generations: dict = {}
+        self._epoch = 0
+
+    def generation(self, key):
+        with self._lock:
+            return self._epoch, self._generations.get(key, 0)
+
+    def _invalidate(self, key) -> None:
+        # Caller holds the lock. Forgetting every count is safe once the epoch
+        # moves on: outstanding readers just skip their set()
+        if len(self._generations) >= self.maxsize:
+            self._generations.clear()
+            self._epoch += 1
+        self._generations[key] = self._generations.get(key, 0) + 1
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires_at = item
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float | None = None, generation=None) -> None:
+        """Store a value; `ttl` overrides the cache-wide lifetime for this entry.
+
+        With `generation`, the value is only stored if the key has not been
+        invalidated since that generation was read.
+        """
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            if generation is not None and generation != (self._epoch, self._generations.get(key, 0)):
+                return
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            self._invalidate(key)
+        return default if item is None else item[0]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._generations.clear()
+            self._epoch += 1
+
+    def __contains__(self, key) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __delitem__(self, key) -> None:
+        with self._lock:
+            del self._data[key]
+            self._invalidate(key)
+
+    def __len__(self) -> int:
+        return len(self._data)
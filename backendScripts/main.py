@@ -1,9 +1,17 @@
 import os
 import asyncio
-import json
+import base64
+import functools
+import hashlib
+import hmac
+import logging
+import sys
+import time
+from collections import Counter
 from datetime import datetime, timedelta, timezone
 
 from backendScripts.seed_data import run_seed
+from backendScripts.migrate import pending_upgrades
 
 _PROJECT_ROOT = os.path.dirname(os.path.dirname(__file__))
 _DOTENV_PATHS = [
@@ -52,58 +60,139 @@ except Exception:
     for i, path in enumerate(_DOTENV_PATHS):
         _load_env_file_fallback(path, override=True)
 
-from fastapi import Depends, FastAPI, HTTPException, status, BackgroundTasks
+from fastapi import Depends, FastAPI, HTTPException, Request, Response, status, BackgroundTasks
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from sqlmodel import Session, select
+from fastapi.responses import ORJSONResponse
+from sqlmodel import Session, delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
 from contextlib import asynccontextmanager
 from typing import Annotated
+import anyio.to_thread
+import bcrypt
 import httpx
-import jwt
-from passlib.context import CryptContext
-from pydantic import BaseModel
+import orjson
+from pydantic import BaseModel, ConfigDict, StringConstraints, TypeAdapter
 from backendScripts.database import (
-    add_user, create_db_and_tables, get_session, get_user_by_username,
-    get_user_friends, add_friend, remove_friend,
+    DB_MAX_OVERFLOW, DB_POOL_SIZE,
+    add_user, create_db_and_tables, engine, get_session, user_exists, find_users_by_username,
+    get_cached_user_by_username, invalidate_cached_user,
+    get_user_friends, get_spotify_link, get_spotify_linked_friends, get_friend_ids, are_friends, friendship_status, invalidate_friendship_status,
+    add_friend, upsert_friendship, remove_friend,
+    get_pending_friend_requests, get_all_pending_friend_requests, get_friend_request_conflicts,
+    get_community_member_rows, get_community_top_songs,
     get_user_communities, get_all_communities, join_community, leave_community,
     get_active_polls, get_poll_with_options, vote_on_poll,
     update_listening_activity, get_friends_listening_activity,
     Users, Community, Poll, PollOption, CommunityMembership, Friendship, ListeningActivity
 )
+from backendScripts.cache import TTLCache
 from fastapi.middleware.cors import CORSMiddleware
 
 
+logger = logging.getLogger(__name__)
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/login")
 
 
-app = FastAPI()
-pwd_context = CryptContext(
-    schemes=["bcrypt"],
-    deprecated="auto",
-)
 SECRET_KEY = os.getenv(
     "JWT_SECRET_KEY",
     "dev-only-change-me",
 )
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "5256000"))
+ACCESS_TOKEN_EXPIRE_SECONDS = ACCESS_TOKEN_EXPIRE_MINUTES * 60
+# Sync routes (DB access, bcrypt hashing in /register and /login) run in anyio's
+# worker threads (40 by default). One thread per pooled DB connection: more would
+# only queue on the pool and fail with QueuePool timeouts under load.
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", str(DB_POOL_SIZE + DB_MAX_OVERFLOW)))
 
+def _requested_workers() -> int:
+    """Worker processes this launch asked for: uvicorn's --workers, else WEB_CONCURRENCY.
+
+    uvicorn's spawned workers inherit the parent's argv, so each one sees the flag.
+    """
+    args = sys.argv[1:]
+    for i, arg in enumerate(args):
+        if arg.startswith("--workers="):
+            return int(arg.split("=", 1)[1])
+        if arg == "--workers" and i + 1 < len(args):
+            return int(args[i + 1])
+    return int(os.getenv("WEB_CONCURRENCY", "1"))
+
+# Caches below live in process memory and are invalidated in place, so only one
+# worker process may serve the app; startup refuses anything more
+WORKERS = _requested_workers()
+MULTI_WORKER_ERROR = (
+    "{} workers requested, but the user, token and friendship caches are per "
+    "process, so extra workers would serve stale logins and friend lists. "
+    "Run a single worker."
+)
 
-@app.on_event("startup")
-def _startup() -> None:
-    run_seed()
 
+# One pooled client for every outbound Spotify call, so keep-alive connections
+# (and their TLS sessions) are reused across requests. Created in lifespan.
+http_client: httpx.AsyncClient | None = None
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global http_client
+    if WORKERS > 1:
+        raise RuntimeError(MULTI_WORKER_ERROR.format(WORKERS))
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_CONNECTIONS // 2,
+        ),
+        timeout=10,
+    )
+    # Tables are created (and seeded) once per process here, not at import;
+    # the blocking DB work runs in a worker thread instead of on the event loop
+    await asyncio.to_thread(run_seed)
+    missing_keys = await asyncio.to_thread(pending_upgrades)
+    if missing_keys:
+        logger.warning(
+            "Database is missing unique keys on %s; run `python -m backendScripts.migrate`",
+            ", ".join(missing_keys),
+        )
+    # Build the dummy login hash now so the first unknown-user login doesn't pay for it
+    await asyncio.to_thread(_dummy_password_hash)
+    try:
+        yield
+    finally:
+        await http_client.aclose()
+
+
+# orjson encodes the response dicts (datetimes included) in C
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# Browser origins allowed to call the API (native Expo clients don't send Origin).
+# Override with a comma-separated CORS_ALLOW_ORIGINS for other hosts.
 origins = [
-    "http://localhost:19006",  # Expo web
-    "http://localhost:5173",   # Vite (if you use it)
-    "*",                       # or be permissive in dev
+    origin.strip()
+    for origin in os.getenv(
+        "CORS_ALLOW_ORIGINS",
+        "http://localhost:19006,"  # Expo web (classic)
+        "http://localhost:8081,"   # Expo web (Metro)
+        "http://localhost:5173",   # Vite (if you use it)
+    ).split(",")
+    if origin.strip()
 ]
+# Optional pattern for origin families (e.g. r"https?://localhost:\d+" in dev),
+# checked with one fullmatch instead of growing the list above
+origin_regex = os.getenv("CORS_ALLOW_ORIGIN_REGEX") or None
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=origins,      # or ["*"] for dev
+    allow_origins=origins,
+    allow_origin_regex=origin_regex,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST", "PUT", "DELETE"],
+    allow_headers=["Authorization", "Content-Type"],
+    max_age=86400,  # let browsers reuse preflight results for a day
 )
 
 class registerData(BaseModel):
@@ -128,14 +217,87 @@ class ListeningActivityUpdate(BaseModel):
 class VoteRequest(BaseModel):
     option_id: int
 
+# Response models: endpoints return ORM rows and pydantic-core serializes them
+class FriendOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+    id: int
+    username: str | None
+    is_online: bool
+    spotify_display_name: str | None
+    spotify_profile_image_url: str | None
+
+class CommunityOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+    id: int
+    name: str
+    description: str | None
+    member_count: int
+    icon_name: str
+    created_at: datetime | None
+
+class PollSummaryOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+    id: int
+    community_id: int
+    title: str
+    description: str | None
+    ends_at: datetime
+    is_active: bool
+
+class PollInfoOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+    id: int
+    title: str
+    description: str | None
+    ends_at: datetime
+
+class PollOptionOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+    id: int
+    song_name: str
+    artist_name: str
+    votes: int
+
+class PollDetailOut(BaseModel):
+    poll: PollInfoOut
+    options: list[PollOptionOut]
+
 
 BCRYPT_MAX_PASSWORD_BYTES = 72
+# Cost factor for new hashes; existing hashes keep the cost they were created with
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+
+def hash_password(password: str) -> str:
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode()
+
+
+def verify_password(password: str, password_hash: str) -> bool:
+    return bcrypt.checkpw(password.encode("utf-8"), password_hash.encode())
+
+
+def password_needs_rehash(password_hash: str) -> bool:
+    """True if the hash was made with a cost other than BCRYPT_ROUNDS ("$2b$<cost>$...")"""
+    try:
+        return int(password_hash.split("$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
+
+
+@functools.lru_cache(maxsize=1)
+def _dummy_password_hash() -> str:
+    return hash_password("tonality-dummy-password")
+
+
+def dummy_verify_password(password: str) -> None:
+    """Spend the same bcrypt time as a real check so unknown usernames aren't detectable by timing"""
+    verify_password(password, _dummy_password_hash())
 
 
 def _validate_password_length(password: str) -> None:
     """bcrypt only uses the first 72 bytes of the password.
 
-    passlib's bcrypt handler raises ValueError for longer secrets.
+    Longer secrets are rejected instead of being silently truncated.
     """
     if len(password.encode("utf-8")) > BCRYPT_MAX_PASSWORD_BYTES:
         raise HTTPException(
@@ -144,15 +306,72 @@ def _validate_password_length(password: str) -> None:
         )
 
 
+def _b64url_encode(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+
+def _b64url_decode(segment: bytes) -> bytes:
+    return base64.urlsafe_b64decode(segment + b"=" * (-len(segment) % 4))
+
+
+# Same bytes PyJWT emits, so tokens issued before the switch still verify
+_JWT_HEADER_SEGMENT = _b64url_encode(b'{"alg":"HS256","typ":"JWT"}')
+_SECRET_KEY_BYTES = SECRET_KEY.encode()
+# HMAC state with the key already absorbed; copies skip the per-call key schedule.
+# Never update() this object itself.
+_SECRET_HMAC = hmac.new(_SECRET_KEY_BYTES, digestmod=hashlib.sha256)
+
+
+def _secret_hmac_sha256(message: bytes) -> bytes:
+    mac = _SECRET_HMAC.copy()
+    mac.update(message)
+    return mac.digest()
+
+
+def encode_hs256(payload: dict) -> str:
+    body = orjson.dumps(payload)
+    signing_input = _JWT_HEADER_SEGMENT + b"." + _b64url_encode(body)
+    return (signing_input + b"." + _b64url_encode(_secret_hmac_sha256(signing_input))).decode()
+
+
+def decode_hs256(token: str) -> dict:
+    """Verify an HS256 token and return its claims.
+
+    Raises ValueError if the token is malformed, badly signed, expired or
+    missing the "sub"/"exp" claims.
+    """
+    signing_input, _, signature = token.encode().rpartition(b".")
+    header, _, body = signing_input.partition(b".")
+    if header != _JWT_HEADER_SEGMENT or not body:
+        raise ValueError("Unsupported token header")
+    if not hmac.compare_digest(_b64url_decode(signature), _secret_hmac_sha256(signing_input)):
+        raise ValueError("Signature verification failed")
+    payload = orjson.loads(_b64url_decode(body))
+    if not isinstance(payload, dict):
+        raise ValueError("Invalid token payload")
+    exp = payload.get("exp")
+    if not isinstance(payload.get("sub"), str) or not isinstance(exp, (int, float)):
+        raise ValueError("Token is missing required claims")
+    if exp <= time.time():
+        raise ValueError("Token has expired")
+    return payload
+
+
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.now(timezone.utc) + expires_delta
-    else:
-        expire = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
+    lifetime = int(expires_delta.total_seconds()) if expires_delta else ACCESS_TOKEN_EXPIRE_SECONDS
+    to_encode["exp"] = int(time.time()) + lifetime
+    return encode_hs256(to_encode)
+
+# sha256(bearer token) -> username, for tokens whose signature and exp already checked out
+_verified_token_cache = TTLCache(maxsize=10000, ttl=60)
+
+def _token_cache_key(token: str) -> bytes:
+    return hashlib.sha256(token.encode()).digest()
+
+def invalidate_token(token: str) -> None:
+    """Drop a bearer token from the verified-token cache (account deletion, logout)"""
+    _verified_token_cache.pop(_token_cache_key(token))
 
 def get_current_user(token: str = Depends(oauth2_scheme), session = Depends(get_session)):
     credentials_exception = HTTPException(
@@ -160,15 +379,19 @@ def get_current_user(token: str = Depends(oauth2_scheme), session = Depends(get_
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str | None = payload.get("sub")
-        if username is None:
+    token_key = _token_cache_key(token)
+    username: str | None = _verified_token_cache.get(token_key)
+    if username is None:
+        try:
+            payload = decode_hs256(token)
+        except ValueError:
             raise credentials_exception
-    except jwt.PyJWTError:
-        raise credentials_exception
+        username = payload["sub"]
+        # Never keep a token cached past its own expiry
+        ttl = min(_verified_token_cache.ttl, payload["exp"] - time.time())
+        _verified_token_cache.set(token_key, username, ttl=ttl)
 
-    user = get_user_by_username(session, username)
+    user = get_cached_user_by_username(session, username)
     if user is None:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -181,16 +404,15 @@ async def read_root():
     return {"Hello": "World"}
 
 @app.post("/api/register")
-async def register(form_data: registerData, session=Depends(get_session)):
-    print("Registering user:", form_data)
-    existing_user = get_user_by_username(session, form_data.username)
+def register(form_data: registerData, session=Depends(get_session)):
+    logger.debug("Registering user %s", form_data.username)
     _validate_password_length(form_data.password)
-    hashed_password = pwd_context.hash(form_data.password)
-    if existing_user:
+    if user_exists(session, form_data.username):
         raise HTTPException(
             status_code=status.HTTP_409_CONFLICT,
             detail="User already exists",
         )
+    hashed_password = hash_password(form_data.password)
     user = add_user(session, form_data.username, hashed_password)
     if not user:
         raise HTTPException(
@@ -198,66 +420,93 @@ async def register(form_data: registerData, session=Depends(get_session)):
             detail="User registration failed",
         )
     access_token = create_access_token(
-        data={"sub": user.username}, expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+        data={"sub": user.username}
     )
     
     return {"username": form_data.username, "access_token": access_token, "token_type": "bearer"}
 
+# user id -> HMAC(secret, username/password/stored hash) of that user's last
+# successful login, so a client re-authenticating within the TTL skips bcrypt.
+# Only successes are cached, and the entry is dropped whenever the stored hash
+# changes or the account is deleted.
+_verified_credential_cache = TTLCache(maxsize=10000, ttl=60)
+
+def _credential_digest(user: Users, password: str) -> bytes:
+    message = "\0".join((user.username, password, user.password_hash)).encode()
+    return _secret_hmac_sha256(message)
+
+def invalidate_verified_credentials(user_id: int) -> None:
+    _verified_credential_cache.pop(user_id)
+
 @app.post("/api/login")
-async def login(form_data: registerData, session = Depends(get_session),):
+def login(form_data: registerData, session = Depends(get_session),):
     _validate_password_length(form_data.password)
-    user = get_user_by_username(session, form_data.username)
-    if not user or not pwd_context.verify(form_data.password, user.password_hash):
+    user = get_cached_user_by_username(session, form_data.username)
+    if user is None:
+        dummy_verify_password(form_data.password)
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Incorrect username or password",
         )
-    token = create_access_token(data={"sub": user.username}, expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
+    verified = _verified_credential_cache.get(user.id)
+    if verified is None or not hmac.compare_digest(verified, _credential_digest(user, form_data.password)):
+        if not verify_password(form_data.password, user.password_hash):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Incorrect username or password",
+            )
+        if password_needs_rehash(user.password_hash):
+            # Move the stored hash to the configured cost while we have the plaintext
+            user.password_hash = hash_password(form_data.password)
+            session.add(user)
+            session.commit()
+            invalidate_cached_user(user.username)
+        _verified_credential_cache.set(user.id, _credential_digest(user, form_data.password))
+    token = create_access_token(data={"sub": user.username})
     if user.spotify_refresh_token:
         return {"access_token": token, "token_type": "bearer", "spotify_refresh_token": user.spotify_refresh_token}
     return {"access_token": token, "token_type": "bearer"} #Spotify Refresh Token + User Access Token
 
 @app.put("/api/link_spotify")
-async def link_spotify(spotify_body: SpotifyLinkBody, session=Depends(get_session), token: str = Depends(oauth2_scheme), user=Depends(get_current_user)):
+def link_spotify(spotify_body: SpotifyLinkBody, session=Depends(get_session), token: str = Depends(oauth2_scheme), user=Depends(get_current_user)):
+    username = user.username
+    user_id = user.id
     user.spotify_refresh_token = spotify_body.spotify_refresh_token
     session.add(user)
     session.commit()
-    session.refresh(user)
+    invalidate_cached_user(username)
+    invalidate_spotify_stats(user_id)
     return {"message": "Spotify account linked successfully"}
 
 @app.post("/api/disconnect_spotify")
-async def disconnect_spotify(session=Depends(get_session), user=Depends(get_current_user)):
+def disconnect_spotify(session=Depends(get_session), user=Depends(get_current_user)):
     """Disconnect Spotify account - clears refresh token and cached access tokens"""
-    print(f"Disconnecting Spotify for user: {user.username} (id={user.id})")
-    
-    # Clear from cache
-    if user.id in _access_token_cache:
-        print(f"Removing user {user.id} from access_token_cache")
-        del _access_token_cache[user.id]
+    # Read up front; commit() expires the instance and re-reading would reload it
+    user_id, username = user.id, user.username
+    logger.debug("Disconnecting Spotify for user %s (id=%s)", username, user_id)
     
     # Reload user from current session to ensure attachment and freshness
-    db_user = session.get(Users, user.id)
+    db_user = session.get(Users, user_id)
     if not db_user:
-        print(f"User {user.id} not found in session")
+        logger.debug("User %s not found in session", user_id)
         raise HTTPException(status_code=404, detail="User not found")
         
     # Clear from database
-    print(f"Clearing spotify_refresh_token for user {db_user.username}")
     db_user.spotify_refresh_token = None
     db_user.spotify_display_name = None
     db_user.spotify_profile_image_url = None
     session.add(db_user)
+    
+    # Also clear any listening activity, as one DELETE in the same transaction
+    result = session.exec(delete(ListeningActivity).where(ListeningActivity.user_id == user_id))
+    logger.debug("Deleting %d listening activity records for user %s", result.rowcount, username)
     session.commit()
-    session.refresh(db_user)
-    print(f"User {db_user.username} spotify_refresh_token is now: {db_user.spotify_refresh_token}")
-    
-    # Also clear any listening activity
-    statement = select(ListeningActivity).where(ListeningActivity.user_id == user.id)
-    activities = session.exec(statement).all()
-    print(f"Deleting {len(activities)} listening activity records for user {user.username}")
-    for activity in activities:
-        session.delete(activity)
-    session.commit()
+    invalidate_cached_user(username)
+    # After the commit, so no new refresh can start from the old token; one still
+    # in flight is discarded instead of re-caching its token
+    discard_spotify_access_token(user_id)
+    invalidate_spotify_stats(user_id)
+    logger.debug("Cleared spotify_refresh_token for user %s", username)
     
     return {"message": "Spotify account disconnected successfully"}
 
@@ -273,7 +522,7 @@ async def get_user_settings(user=Depends(get_current_user)):
     }
 
 @app.put("/api/user/settings")
-async def update_user_settings(settings: UserSettingsUpdate, session=Depends(get_session), user=Depends(get_current_user)):
+def update_user_settings(settings: UserSettingsUpdate, session=Depends(get_session), user=Depends(get_current_user)):
     """Update user privacy and status settings"""
     if settings.is_online is not None:
         user.is_online = settings.is_online
@@ -282,37 +531,58 @@ async def update_user_settings(settings: UserSettingsUpdate, session=Depends(get
     if settings.allow_friend_requests is not None:
         user.allow_friend_requests = settings.allow_friend_requests
     
+    # Read before commit expires the instance, so no reload SELECT is needed
+    username = user.username
     session.add(user)
     session.commit()
-    session.refresh(user)
+    invalidate_cached_user(username)
     return {"message": "Settings updated successfully"}
 
 @app.delete("/api/user/account")
-async def delete_account(session=Depends(get_session), user=Depends(get_current_user)):
+def delete_account(session=Depends(get_session), token: str = Depends(oauth2_scheme), user=Depends(get_current_user)):
     """Delete user account (placeholder - implement full cascade deletion)"""
     # TODO: Delete all user data including friendships, votes, etc.
+    user_id, username = user.id, user.username
     session.delete(user)
     session.commit()
+    invalidate_token(token)
+    invalidate_cached_user(username)
+    invalidate_verified_credentials(user_id)
+    discard_spotify_access_token(user_id)
+    invalidate_spotify_stats(user_id)
     return {"message": "Account deleted successfully"}
 
+# ============= Conditional Responses =============
+
+def body_etag(body: bytes) -> str:
+    return '"' + hashlib.sha1(body, usedforsecurity=False).hexdigest() + '"'
+
+def etag_response(request: Request, body: bytes, cache_control: str, etag: str | None = None):
+    """Send a JSON body with its ETag, or an empty 304 when If-None-Match matches it"""
+    etag = etag or body_etag(body)
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        # Weak comparison (RFC 9110 13.1.2): ignore any W/ prefix on either side
+        candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        if "*" in candidates or etag.removeprefix("W/") in candidates:
+            return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
 # ============= Friends Management =============
 
 @app.get("/api/users/search")
-async def search_users(q: str, session=Depends(get_session), user=Depends(get_current_user)):
+def search_users(q: str, session=Depends(get_session), user=Depends(get_current_user)):
     """Search for users by username"""
-    from sqlmodel import select
-    from backendScripts.database import Users
-    
+    q = q.strip()
     if len(q) < 2:
         return []
     
     # Search for users whose username contains the query (case-insensitive)
-    statement = select(Users).where(Users.username.ilike(f"%{q}%")).where(Users.id != user.id)
-    results = session.exec(statement).all()
+    results = find_users_by_username(session, q, user.id)
     
     # Get current user's friend IDs to mark who is already a friend
-    current_friends = get_user_friends(session, user.id)
-    friend_ids = {f.id for f in current_friends}
+    friend_ids = get_friend_ids(session, user.id)
     
     return [{
         "id": u.id,
@@ -320,22 +590,48 @@ async def search_users(q: str, session=Depends(get_session), user=Depends(get_cu
         "spotify_display_name": u.spotify_display_name,
         "spotify_profile_image_url": u.spotify_profile_image_url,
         "is_friend": u.id in friend_ids
-    } for u in results[:10]]  # Limit to 10 results
+    } for u in results]
 
 class FriendRequestByUsername(BaseModel):
     username: str
 
+class AddFriendByUsername(BaseModel):
+    username: Annotated[str, StringConstraints(strip_whitespace=True, min_length=1)]
+
 # ============= Friend Requests System =============
 
+def _create_friend_request(session: Session, user_id: int, target_id: int) -> Friendship:
+    """Insert a pending request from user_id to target_id, or raise the matching 400"""
+    # Our row to them (any status) and their pending row to us, in one query
+    rows = get_friend_request_conflicts(session, user_id, target_id)
+    for row in rows:
+        if row.user_id == user_id and row.status == "accepted":
+            raise HTTPException(status_code=400, detail="Already friends with this user")
+        if row.user_id == user_id and row.status == "pending":
+            raise HTTPException(status_code=400, detail="Friend request already sent")
+    if any(row.user_id == target_id for row in rows):
+        raise HTTPException(status_code=400, detail="This user has already sent you a request. Accept it instead!")
+    
+    # UNIQUE (user_id, friend_id) catches a concurrent duplicate
+    friendship = Friendship(user_id=user_id, friend_id=target_id, status="pending")
+    session.add(friendship)
+    try:
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        raise HTTPException(status_code=400, detail="Friend request already sent")
+    invalidate_friendship_status(user_id, target_id)
+    return friendship
+
 @app.post("/api/friends/request-by-username")
-async def send_friend_request_by_username(data: FriendRequestByUsername, session=Depends(get_session), user=Depends(get_current_user)):
+def send_friend_request_by_username(data: FriendRequestByUsername, session=Depends(get_session), user=Depends(get_current_user)):
     """Send a friend request to another user by username"""
     username = data.username.strip().lstrip('@')  # Remove @ if present
     if not username:
         raise HTTPException(status_code=400, detail="Username is required")
     
     # Find the target user
-    target = get_user_by_username(session, username)
+    target = get_cached_user_by_username(session, username)
     if not target:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -346,32 +642,7 @@ async def send_friend_request_by_username(data: FriendRequestByUsername, session
     if not target.allow_friend_requests:
         raise HTTPException(status_code=403, detail="User is not accepting friend requests")
     
-    # Check if already friends or request pending
-    statement = select(Friendship).where(
-        Friendship.user_id == user.id,
-        Friendship.friend_id == target.id
-    )
-    existing = session.exec(statement).first()
-    if existing:
-        if existing.status == "accepted":
-            raise HTTPException(status_code=400, detail="Already friends with this user")
-        elif existing.status == "pending":
-            raise HTTPException(status_code=400, detail="Friend request already sent")
-    
-    # Check if they already sent us a request
-    statement = select(Friendship).where(
-        Friendship.user_id == target.id,
-        Friendship.friend_id == user.id,
-        Friendship.status == "pending"
-    )
-    incoming = session.exec(statement).first()
-    if incoming:
-        raise HTTPException(status_code=400, detail="This user has already sent you a request. Accept it instead!")
-    
-    # Create pending friendship
-    friendship = Friendship(user_id=user.id, friend_id=target.id, status="pending")
-    session.add(friendship)
-    session.commit()
+    friendship = _create_friend_request(session, user.id, target.id)
     
     return {"message": "Friend request sent", "request_id": friendship.id, "user": {
         "id": target.id,
@@ -380,7 +651,7 @@ async def send_friend_request_by_username(data: FriendRequestByUsername, session
     }}
 
 @app.post("/api/friends/request/{user_id}")
-async def send_friend_request(user_id: int, session=Depends(get_session), user=Depends(get_current_user)):
+def send_friend_request(user_id: int, session=Depends(get_session), user=Depends(get_current_user)):
     """Send a friend request to another user"""
     if user_id == user.id:
         raise HTTPException(status_code=400, detail="Cannot send friend request to yourself")
@@ -394,78 +665,27 @@ async def send_friend_request(user_id: int, session=Depends(get_session), user=D
     if not target.allow_friend_requests:
         raise HTTPException(status_code=403, detail="User is not accepting friend requests")
     
-    # Check if already friends or request pending
-    statement = select(Friendship).where(
-        Friendship.user_id == user.id,
-        Friendship.friend_id == user_id
-    )
-    existing = session.exec(statement).first()
-    if existing:
-        if existing.status == "accepted":
-            raise HTTPException(status_code=400, detail="Already friends with this user")
-        elif existing.status == "pending":
-            raise HTTPException(status_code=400, detail="Friend request already sent")
-    
-    # Check if they already sent us a request
-    statement = select(Friendship).where(
-        Friendship.user_id == user_id,
-        Friendship.friend_id == user.id,
-        Friendship.status == "pending"
-    )
-    incoming = session.exec(statement).first()
-    if incoming:
-        raise HTTPException(status_code=400, detail="This user has already sent you a request. Accept it instead!")
-    
-    # Create pending friendship
-    friendship = Friendship(user_id=user.id, friend_id=user_id, status="pending")
-    session.add(friendship)
-    session.commit()
+    friendship = _create_friend_request(session, user.id, user_id)
     
     return {"message": "Friend request sent", "request_id": friendship.id}
 
 @app.get("/api/friends/requests")
-async def get_friend_requests(session=Depends(get_session), user=Depends(get_current_user)):
+def get_friend_requests(session=Depends(get_session), user=Depends(get_current_user)):
     """Get pending friend requests (both incoming and outgoing)"""
-    # Incoming requests (others requesting to be our friend)
-    statement = select(Friendship).where(
-        Friendship.friend_id == user.id,
-        Friendship.status == "pending"
-    )
-    incoming = session.exec(statement).all()
-    
-    # Outgoing requests (our pending requests)
-    statement = select(Friendship).where(
-        Friendship.user_id == user.id,
-        Friendship.status == "pending"
-    )
-    outgoing = session.exec(statement).all()
-    
-    # Get user details
-    incoming_details = []
-    for req in incoming:
-        sender = session.get(Users, req.user_id)
-        if sender:
-            incoming_details.append({
-                "request_id": req.id,
-                "user_id": sender.id,
-                "username": sender.username,
-                "spotify_display_name": sender.spotify_display_name,
-                "spotify_profile_image_url": sender.spotify_profile_image_url,
-                "created_at": req.created_at.isoformat()
-            })
-    
-    outgoing_details = []
-    for req in outgoing:
-        recipient = session.get(Users, req.friend_id)
-        if recipient:
-            outgoing_details.append({
-                "request_id": req.id,
-                "user_id": recipient.id,
-                "username": recipient.username,
-                "spotify_display_name": recipient.spotify_display_name,
-                "spotify_profile_image_url": recipient.spotify_profile_image_url,
-                "created_at": req.created_at.isoformat()
-            })
+    def details(rows):
+        return [{
+            "request_id": row.request_id,
+            "user_id": row.user_id,
+            "username": row.username,
+            "spotify_display_name": row.spotify_display_name,
+            "spotify_profile_image_url": row.spotify_profile_image_url,
+            "created_at": row.created_at
+        } for row in rows]
+    
+    # Incoming (others requesting to be our friend) and outgoing (our pending requests)
+    incoming, outgoing = get_all_pending_friend_requests(session, user.id)
+    incoming_details = details(incoming)
+    outgoing_details = details(outgoing)
     
     return {
         "incoming": incoming_details,
@@ -474,57 +694,37 @@ async def get_friend_requests(session=Depends(get_session), user=Depends(get_cur
     }
 
 @app.get("/api/friends/requests/incoming")
-async def get_incoming_requests(session=Depends(get_session), user=Depends(get_current_user)):
+def get_incoming_requests(session=Depends(get_session), user=Depends(get_current_user)):
     """Get incoming friend requests"""
-    statement = select(Friendship).where(
-        Friendship.friend_id == user.id,
-        Friendship.status == "pending"
-    )
-    requests = session.exec(statement).all()
-    
-    result = []
-    for req in requests:
-        sender = session.get(Users, req.user_id)
-        if sender:
-            result.append({
-                "id": req.id,
-                "from_user": {
-                    "id": sender.id,
-                    "username": sender.username,
-                    "spotify_display_name": sender.spotify_display_name,
-                    "spotify_profile_image_url": sender.spotify_profile_image_url
-                },
-                "created_at": req.created_at.isoformat()
-            })
-    return result
+    requests = get_pending_friend_requests(session, user.id, incoming=True)
+    return [{
+        "id": req.request_id,
+        "from_user": {
+            "id": req.user_id,
+            "username": req.username,
+            "spotify_display_name": req.spotify_display_name,
+            "spotify_profile_image_url": req.spotify_profile_image_url
+        },
+        "created_at": req.created_at
+    } for req in requests]
 
 @app.get("/api/friends/requests/outgoing")
-async def get_outgoing_requests(session=Depends(get_session), user=Depends(get_current_user)):
+def get_outgoing_requests(session=Depends(get_session), user=Depends(get_current_user)):
     """Get outgoing friend requests"""
-    statement = select(Friendship).where(
-        Friendship.user_id == user.id,
-        Friendship.status == "pending"
-    )
-    requests = session.exec(statement).all()
-    
-    result = []
-    for req in requests:
-        recipient = session.get(Users, req.friend_id)
-        if recipient:
-            result.append({
-                "id": req.id,
-                "to_user": {
-                    "id": recipient.id,
-                    "username": recipient.username,
-                    "spotify_display_name": recipient.spotify_display_name,
-                    "spotify_profile_image_url": recipient.spotify_profile_image_url
-                },
-                "created_at": req.created_at.isoformat()
-            })
-    return result
+    requests = get_pending_friend_requests(session, user.id, incoming=False)
+    return [{
+        "id": req.request_id,
+        "to_user": {
+            "id": req.user_id,
+            "username": req.username,
+            "spotify_display_name": req.spotify_display_name,
+            "spotify_profile_image_url": req.spotify_profile_image_url
+        },
+        "created_at": req.created_at
+    } for req in requests]
 
 @app.post("/api/friends/requests/{request_id}/accept")
-async def accept_friend_request(request_id: int, session=Depends(get_session), user=Depends(get_current_user)):
+def accept_friend_request(request_id: int, session=Depends(get_session), user=Depends(get_current_user)):
     """Accept a friend request"""
     # Find the request
     friendship = session.get(Friendship, request_id)
@@ -539,18 +739,20 @@ async def accept_friend_request(request_id: int, session=Depends(get_session), u
         raise HTTPException(status_code=400, detail="Request is not pending")
     
     # Accept the request
+    requester_id = friendship.user_id
     friendship.status = "accepted"
     session.add(friendship)
     
-    # Create reverse friendship
-    reverse = Friendship(user_id=user.id, friend_id=friendship.user_id, status="accepted")
-    session.add(reverse)
+    # Create the reverse friendship; after mutual requests our pending row already
+    # exists, and UNIQUE (user_id, friend_id) means it is accepted in place
+    upsert_friendship(session, user.id, requester_id, "accepted")
     session.commit()
+    invalidate_friendship_status(user.id, requester_id)
     
     return {"message": "Friend request accepted"}
 
 @app.post("/api/friends/requests/{request_id}/reject")
-async def reject_friend_request(request_id: int, session=Depends(get_session), user=Depends(get_current_user)):
+def reject_friend_request(request_id: int, session=Depends(get_session), user=Depends(get_current_user)):
     """Reject a friend request"""
     friendship = session.get(Friendship, request_id)
     if not friendship:
@@ -563,13 +765,15 @@ async def reject_friend_request(request_id: int, session=Depends(get_session), u
         raise HTTPException(status_code=400, detail="Request is not pending")
     
     # Delete the request
+    requester_id = friendship.user_id
     session.delete(friendship)
     session.commit()
+    invalidate_friendship_status(user.id, requester_id)
     
     return {"message": "Friend request rejected"}
 
 @app.delete("/api/friends/requests/{request_id}")
-async def cancel_friend_request(request_id: int, session=Depends(get_session), user=Depends(get_current_user)):
+def cancel_friend_request(request_id: int, session=Depends(get_session), user=Depends(get_current_user)):
     """Cancel an outgoing friend request"""
     friendship = session.get(Friendship, request_id)
     if not friendship:
@@ -581,20 +785,18 @@ async def cancel_friend_request(request_id: int, session=Depends(get_session), u
     if friendship.status != "pending":
         raise HTTPException(status_code=400, detail="Request is not pending")
     
+    target_id = friendship.friend_id
     session.delete(friendship)
     session.commit()
+    invalidate_friendship_status(user.id, target_id)
     
     return {"message": "Friend request cancelled"}
 
 @app.post("/api/friends/add-by-username")
-async def add_friend_by_username(data: dict, session=Depends(get_session), user=Depends(get_current_user)):
+def add_friend_by_username(data: AddFriendByUsername, session=Depends(get_session), user=Depends(get_current_user)):
     """Add a friend by username"""
-    username = data.get("username", "").strip()
-    if not username:
-        raise HTTPException(status_code=400, detail="Username is required")
-    
     # Find the user
-    friend = get_user_by_username(session, username)
+    friend = get_cached_user_by_username(session, data.username)
     if not friend:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -602,41 +804,35 @@ async def add_friend_by_username(data: dict, session=Depends(get_session), user=
         raise HTTPException(status_code=400, detail="Cannot add yourself as friend")
     
     # Check if already friends
-    existing_friends = get_user_friends(session, user.id)
-    if any(f.id == friend.id for f in existing_friends):
+    if are_friends(session, user.id, friend.id):
         raise HTTPException(status_code=400, detail="Already friends with this user")
     
-    friendship = add_friend(session, user.id, friend.id)
-    if not friendship:
+    if not add_friend(session, user.id, friend.id):
         raise HTTPException(status_code=400, detail="Failed to add friend")
     
     return {"message": "Friend added successfully", "friend_id": friend.id}
 
-@app.get("/api/friends")
-async def get_friends(session=Depends(get_session), user=Depends(get_current_user)):
+_FRIEND_LIST = TypeAdapter(list[FriendOut])
+
+@app.get("/api/friends", response_model=list[FriendOut])
+def get_friends(request: Request, session=Depends(get_session), user=Depends(get_current_user)):
     """Get list of current user's friends"""
     friends = get_user_friends(session, user.id)
-    return [{
-        "id": friend.id,
-        "username": friend.username,
-        "is_online": friend.is_online,
-        "spotify_display_name": friend.spotify_display_name,
-        "spotify_profile_image_url": friend.spotify_profile_image_url
-    } for friend in friends]
+    body = _FRIEND_LIST.dump_json(_FRIEND_LIST.validate_python(friends, from_attributes=True))
+    return etag_response(request, body, "private, no-cache")
 
 @app.post("/api/friends/{friend_id}")
-async def add_friend_endpoint(friend_id: int, session=Depends(get_session), user=Depends(get_current_user)):
+def add_friend_endpoint(friend_id: int, session=Depends(get_session), user=Depends(get_current_user)):
     """Add a friend"""
     if friend_id == user.id:
         raise HTTPException(status_code=400, detail="Cannot add yourself as friend")
     
-    friendship = add_friend(session, user.id, friend_id)
-    if not friendship:
+    if not add_friend(session, user.id, friend_id):
         raise HTTPException(status_code=400, detail="Failed to add friend")
     return {"message": "Friend added successfully"}
 
 @app.delete("/api/friends/{friend_id}")
-async def remove_friend_endpoint(friend_id: int, session=Depends(get_session), user=Depends(get_current_user)):
+def remove_friend_endpoint(friend_id: int, session=Depends(get_session), user=Depends(get_current_user)):
     """Remove a friend"""
     success = remove_friend(session, user.id, friend_id)
     if not success:
@@ -644,34 +840,34 @@ async def remove_friend_endpoint(friend_id: int, session=Depends(get_session), u
     return {"message": "Friend removed successfully"}
 
 @app.get("/api/friends/activity")
-async def get_friends_activity(session=Depends(get_session), user=Depends(get_current_user)):
+def get_friends_activity(session=Depends(get_session), user=Depends(get_current_user)):
     """Get what friends are currently listening to"""
     activities = get_friends_listening_activity(session, user.id)
     return [{
         "user": {
-            "id": item["user"].id,
-            "username": item["user"].username,
-            "spotify_display_name": item["user"].spotify_display_name,
-            "spotify_profile_image_url": item["user"].spotify_profile_image_url,
-            "is_online": item["user"].is_online
+            "id": row.id,
+            "username": row.username,
+            "spotify_display_name": row.spotify_display_name,
+            "spotify_profile_image_url": row.spotify_profile_image_url,
+            "is_online": row.is_online
         },
         "activity": {
-            "track_name": item["activity"].track_name,
-            "artist_name": item["activity"].artist_name,
-            "album_name": item["activity"].album_name,
-            "album_image_url": item["activity"].album_image_url,
-            "started_at": item["activity"].started_at.isoformat(),
-            "updated_at": item["activity"].updated_at.isoformat()
+            "track_name": row.track_name,
+            "artist_name": row.artist_name,
+            "album_name": row.album_name,
+            "album_image_url": row.album_image_url,
+            "started_at": row.started_at,
+            "updated_at": row.updated_at
         }
-    } for item in activities]
+    } for row in activities]
 
 @app.post("/api/user/listening")
-async def update_listening(activity: ListeningActivityUpdate, session=Depends(get_session), user=Depends(get_current_user)):
+def update_listening(activity: ListeningActivityUpdate, session=Depends(get_session), user=Depends(get_current_user)):
     """Update what the user is currently listening to"""
     if not user.show_listening_activity:
         raise HTTPException(status_code=403, detail="Listening activity is disabled")
     
-    updated = update_listening_activity(
+    update_listening_activity(
         session, user.id,
         activity.track_name, activity.artist_name,
         activity.album_name, activity.album_image_url, activity.spotify_uri
@@ -680,133 +876,104 @@ async def update_listening(activity: ListeningActivityUpdate, session=Depends(ge
 
 # ============= Communities =============
 
-@app.get("/api/communities")
-async def get_communities(session=Depends(get_session)):
+_COMMUNITY_LIST = TypeAdapter(list[CommunityOut])
+# (body, etag) for /api/communities; dropped whenever a member count or the list changes
+_communities_cache = TTLCache(maxsize=1, ttl=60)
+COMMUNITY_CACHE_CONTROL = "public, max-age=30"
+
+def invalidate_communities_cache() -> None:
+    _communities_cache.clear()
+
+@app.get("/api/communities", response_model=list[CommunityOut])
+def get_communities(request: Request, session=Depends(get_session)):
     """Get all communities"""
-    communities = session.exec(select(Community)).all()
-    return communities
+    cached = _communities_cache.get("all")
+    if cached is None:
+        generation = _communities_cache.generation("all")
+        communities = session.exec(select(
+            Community.id, Community.name, Community.description,
+            Community.member_count, Community.icon_name, Community.created_at,
+        )).all()
+        body = _COMMUNITY_LIST.dump_json(
+            _COMMUNITY_LIST.validate_python(communities, from_attributes=True)
+        )
+        cached = (body, body_etag(body))
+        _communities_cache.set("all", cached, generation=generation)
+    body, etag = cached
+    return etag_response(request, body, COMMUNITY_CACHE_CONTROL, etag)
 
-@app.get("/api/communities/my")
-async def get_my_communities(session=Depends(get_session), user=Depends(get_current_user)):
+@app.get("/api/communities/my", response_model=list[CommunityOut])
+def get_my_communities(session=Depends(get_session), user=Depends(get_current_user)):
     """Get communities the current user has joined"""
     communities = get_user_communities(session, user.id)
     return communities
 
 @app.post("/api/communities/{community_id}/join")
-async def join_community_endpoint(community_id: int, session=Depends(get_session), user=Depends(get_current_user)):
+def join_community_endpoint(community_id: int, session=Depends(get_session), user=Depends(get_current_user)):
     """Join a community"""
     community = session.get(Community, community_id)
     if not community:
         raise HTTPException(status_code=404, detail="Community not found")
     
-    # Check if already a member
-    existing = session.exec(
-        select(CommunityMembership).where(
-            CommunityMembership.user_id == user.id,
-            CommunityMembership.community_id == community_id
-        )
-    ).first()
-    if existing:
-        raise HTTPException(status_code=400, detail="Already a member of this community")
-    
     membership = join_community(session, user.id, community_id)
+    if membership is None:
+        raise HTTPException(status_code=400, detail="Already a member of this community")
+    invalidate_communities_cache()
     return {"message": "Joined community successfully", "community_id": community_id}
 
 @app.delete("/api/communities/{community_id}/leave")
-async def leave_community_endpoint(community_id: int, session=Depends(get_session), user=Depends(get_current_user)):
+def leave_community_endpoint(community_id: int, session=Depends(get_session), user=Depends(get_current_user)):
     """Leave a community"""
     success = leave_community(session, user.id, community_id)
     if not success:
         raise HTTPException(status_code=404, detail="Membership not found or not a member")
+    invalidate_communities_cache()
     return {"message": "Left community successfully"}
 
-@app.get("/api/communities/{community_id}")
-async def get_community(community_id: int, session=Depends(get_session)):
+@app.get("/api/communities/{community_id}", response_model=CommunityOut)
+def get_community(community_id: int, request: Request, session=Depends(get_session)):
     """Get community details"""
     community = session.get(Community, community_id)
     if not community:
         raise HTTPException(status_code=404, detail="Community not found")
-    return community
+    body = CommunityOut.model_validate(community).model_dump_json().encode()
+    return etag_response(request, body, COMMUNITY_CACHE_CONTROL)
 
 @app.get("/api/communities/{community_id}/members")
-async def get_community_members(community_id: int, session=Depends(get_session), user=Depends(get_current_user)):
+def get_community_members(community_id: int, session=Depends(get_session), user=Depends(get_current_user)):
     """Get members of a community"""
     community = session.get(Community, community_id)
     if not community:
         raise HTTPException(status_code=404, detail="Community not found")
     
-    # Get all memberships
-    statement = select(CommunityMembership).where(CommunityMembership.community_id == community_id)
-    memberships = session.exec(statement).all()
-    
-    # Get user details
-    members = []
-    for m in memberships:
-        member = session.get(Users, m.user_id)
-        if member:
-            # Check if this user is friend with current user
-            is_friend = False
-            if member.id != user.id:
-                friend_check = session.exec(
-                    select(Friendship).where(
-                        Friendship.user_id == user.id,
-                        Friendship.friend_id == member.id,
-                        Friendship.status == "accepted"
-                    )
-                ).first()
-                is_friend = friend_check is not None
-            
-            members.append({
-                "id": member.id,
-                "username": member.username,
-                "spotify_display_name": member.spotify_display_name,
-                "spotify_profile_image_url": member.spotify_profile_image_url,
-                "is_online": member.is_online,
-                "is_friend": is_friend,
-                "is_self": member.id == user.id,
-                "joined_at": m.joined_at.isoformat()
-            })
+    # One join for the members, one query for our friend IDs
+    rows = get_community_member_rows(session, community_id)
+    friend_ids = get_friend_ids(session, user.id)
+    members = [{
+        "id": row.id,
+        "username": row.username,
+        "spotify_display_name": row.spotify_display_name,
+        "spotify_profile_image_url": row.spotify_profile_image_url,
+        "is_online": row.is_online,
+        "is_friend": row.id in friend_ids,
+        "is_self": row.id == user.id,
+        "joined_at": row.joined_at
+    } for row in rows]
     
     return {"members": members, "count": len(members)}
 
 @app.get("/api/communities/{community_id}/top-songs")
-async def get_community_top_songs(community_id: int, session=Depends(get_session)):
+def get_community_top_songs_endpoint(community_id: int, session=Depends(get_session)):
     """Get top songs in a community based on member listening activity"""
-    # Get all memberships
-    statement = select(CommunityMembership).where(CommunityMembership.community_id == community_id)
-    memberships = session.exec(statement).all()
-    member_ids = [m.user_id for m in memberships]
-    
-    if not member_ids:
-        return {"songs": []}
-    
-    # Get listening activities of members
-    statement = select(ListeningActivity).where(ListeningActivity.user_id.in_(member_ids))
-    activities = session.exec(statement).all()
-    
-    # Aggregate songs by play count
-    song_counts = {}
-    for activity in activities:
-        key = f"{activity.track_name}|{activity.artist_name}"
-        if key not in song_counts:
-            song_counts[key] = {
-                "track_name": activity.track_name,
-                "artist_name": activity.artist_name,
-                "album_name": activity.album_name,
-                "album_image_url": activity.album_image_url,
-                "spotify_uri": activity.spotify_uri,
-                "count": 0
-            }
-        song_counts[key]["count"] += 1
-    
-    # Sort by count and return top 5
-    sorted_songs = sorted(song_counts.values(), key=lambda x: x["count"], reverse=True)
-    return {"songs": sorted_songs[:5]}
+    rows = get_community_top_songs(session, community_id)
+    return {"songs": [dict(row._mapping) for row in rows]}
 
 # ============= User Profiles =============
 
+_PENDING_REQUEST_DIRECTION = {"pending_out": "outgoing", "pending_in": "incoming"}
+
 @app.get("/api/users/{user_id}/profile")
-async def get_user_profile(user_id: int, session=Depends(get_session), current_user=Depends(get_current_user)):
+def get_user_profile(user_id: int, session=Depends(get_session), current_user=Depends(get_current_user)):
     """Get a user's public profile"""
     user = session.get(Users, user_id)
     if not user:
@@ -816,65 +983,35 @@ async def get_user_profile(user_id: int, session=Depends(get_session), current_u
     is_friend = False
     pending_request = None
     if user_id != current_user.id:
-        # Check if friends
-        friend_check = session.exec(
-            select(Friendship).where(
-                Friendship.user_id == current_user.id,
-                Friendship.friend_id == user_id,
-                Friendship.status == "accepted"
-            )
-        ).first()
-        is_friend = friend_check is not None
-        
-        # Check for pending request
-        pending_check = session.exec(
-            select(Friendship).where(
-                Friendship.user_id == current_user.id,
-                Friendship.friend_id == user_id,
-                Friendship.status == "pending"
-            )
-        ).first()
-        if pending_check:
-            pending_request = "outgoing"
-        else:
-            incoming_check = session.exec(
-                select(Friendship).where(
-                    Friendship.user_id == user_id,
-                    Friendship.friend_id == current_user.id,
-                    Friendship.status == "pending"
-                )
-            ).first()
-            if incoming_check:
-                pending_request = "incoming"
+        relation = friendship_status(session, current_user.id, user_id)
+        is_friend = relation == "friend"
+        pending_request = _PENDING_REQUEST_DIRECTION.get(relation)
     
     # Get listening activity if allowed
     listening_activity = None
     if user.show_listening_activity:
         activity = session.exec(
-            select(ListeningActivity).where(ListeningActivity.user_id == user_id)
+            select(
+                ListeningActivity.track_name, ListeningActivity.artist_name,
+                ListeningActivity.album_name, ListeningActivity.album_image_url,
+                ListeningActivity.spotify_uri,
+            ).where(ListeningActivity.user_id == user_id)
         ).first()
         if activity:
-            listening_activity = {
-                "track_name": activity.track_name,
-                "artist_name": activity.artist_name,
-                "album_name": activity.album_name,
-                "album_image_url": activity.album_image_url,
-                "spotify_uri": activity.spotify_uri
-            }
+            listening_activity = dict(activity._mapping)
     
     # Get communities this user is in
-    statement = select(CommunityMembership).where(CommunityMembership.user_id == user_id)
-    memberships = session.exec(statement).all()
-    community_ids = [m.community_id for m in memberships]
-    communities = []
-    for cid in community_ids:
-        community = session.get(Community, cid)
-        if community:
-            communities.append({
-                "id": community.id,
-                "name": community.name,
-                "icon_name": community.icon_name
-            })
+    statement = (
+        select(Community.id, Community.name, Community.icon_name)
+        .join(CommunityMembership, CommunityMembership.community_id == Community.id)
+        .where(CommunityMembership.user_id == user_id)
+        .order_by(CommunityMembership.id)
+    )
+    communities = [{
+        "id": row.id,
+        "name": row.name,
+        "icon_name": row.icon_name
+    } for row in session.exec(statement)]
     
     return {
         "id": user.id,
@@ -897,6 +1034,29 @@ def _get_spotify_client_credentials() -> tuple[str, str]:
     client_secret = os.getenv("SPOTIFY_CLIENT_SECRET", "").strip()
     return client_id, client_secret
 
+def _normalize_track(track: dict, *, include_album: bool = True, include_preview: bool = False) -> dict:
+    """Map a Spotify track object to the track dict the API returns"""
+    artists = track.get("artists")
+    album = track.get("album") or {}
+    images = album.get("images")
+    normalized = {
+        "id": track.get("id"),
+        "name": track.get("name"),
+        "artist": artists[0]["name"] if artists else "Unknown",
+    }
+    if include_album:
+        normalized["album"] = album["name"] if album else None
+    normalized["album_image_url"] = images[0]["url"] if images else None
+    normalized["spotify_uri"] = track.get("uri")
+    if include_preview:
+        normalized["preview_url"] = track.get("preview_url")
+    return normalized
+
+def _search_tracks(data: dict) -> list[dict]:
+    """Track objects from a Spotify search response"""
+    tracks = data.get("tracks")
+    return tracks.get("items") or [] if tracks else []
+
 # Song of the Day persistence file path
 _SONG_OF_DAY_CACHE_FILE = os.path.join(os.path.dirname(__file__), "song_of_day_cache.json")
 
@@ -904,8 +1064,8 @@ def _load_song_of_day_cache() -> dict:
     """Load Song of the Day cache from file"""
     try:
         if os.path.exists(_SONG_OF_DAY_CACHE_FILE):
-            with open(_SONG_OF_DAY_CACHE_FILE, "r") as f:
-                return json.load(f)
+            with open(_SONG_OF_DAY_CACHE_FILE, "rb") as f:
+                return orjson.loads(f.read())
     except Exception as e:
         print(f"Error loading song of day cache: {e}")
     return {"track": None, "date": None}
@@ -913,13 +1073,18 @@ def _load_song_of_day_cache() -> dict:
 def _save_song_of_day_cache(cache: dict) -> None:
     """Save Song of the Day cache to file"""
     try:
-        with open(_SONG_OF_DAY_CACHE_FILE, "w") as f:
-            json.dump(cache, f)
+        # Write then rename, so another worker never reads a half-written file
+        tmp_path = f"{_SONG_OF_DAY_CACHE_FILE}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(orjson.dumps(cache))
+        os.replace(tmp_path, _SONG_OF_DAY_CACHE_FILE)
     except Exception as e:
         print(f"Error saving song of day cache: {e}")
 
 # Global Song of the Day cache (same for all users) - loaded from file for persistence
 _song_of_day_cache: dict = _load_song_of_day_cache()
+# Held while refreshing so concurrent first requests of the day share one Spotify fetch
+_song_of_day_lock = asyncio.Lock()
 
 async def get_spotify_client_credentials_token() -> str | None:
     """Get a Spotify access token using client credentials flow (no user auth needed)"""
@@ -931,27 +1096,35 @@ async def get_spotify_client_credentials_token() -> str | None:
     import base64
     auth_header = base64.b64encode(f"{spotify_client_id}:{spotify_client_secret}".encode()).decode()
     
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            "https://accounts.spotify.com/api/token",
-            data={"grant_type": "client_credentials"},
-            headers={
-                "Content-Type": "application/x-www-form-urlencoded",
-                "Authorization": f"Basic {auth_header}"
-            }
-        )
-        if response.status_code == 200:
-            return response.json().get("access_token")
-        else:
-            print(f"Failed to get client credentials token: {response.status_code}")
-            return None
+    response = await http_client.post(
+        "https://accounts.spotify.com/api/token",
+        data={"grant_type": "client_credentials"},
+        headers={
+            "Content-Type": "application/x-www-form-urlencoded",
+            "Authorization": f"Basic {auth_header}"
+        }
+    )
+    if response.status_code == 200:
+        return orjson.loads(response.content).get("access_token")
+    else:
+        print(f"Failed to get client credentials token: {response.status_code}")
+        return None
 
 @app.get("/api/song-of-day")
-async def get_song_of_day():
+async def get_song_of_day(request: Request):
     """
     Get the global Song of the Day - same for all users.
     Searches for popular tracks from various genres, cached for the entire day.
     """
+    payload = await _song_of_day_payload()
+    track = payload.get("track")
+    if not track:
+        return payload
+    # Weak: only the "cached" flag differs between responses for the same song
+    etag = f'W/"sotd-{track["id"]}"'
+    return etag_response(request, orjson.dumps(payload), "public, max-age=60", etag)
+
+async def _song_of_day_payload() -> dict:
     global _song_of_day_cache
     
     today = datetime.now(timezone.utc).date().isoformat()
@@ -960,65 +1133,73 @@ async def get_song_of_day():
     if _song_of_day_cache["date"] == today and _song_of_day_cache["track"]:
         return {"track": _song_of_day_cache["track"], "cached": True}
     
+    async with _song_of_day_lock:
+        # Filled while we waited, or by another worker process that shares the file
+        if _song_of_day_cache["date"] != today:
+            on_disk = await asyncio.to_thread(_load_song_of_day_cache)
+            if on_disk.get("date") == today and on_disk.get("track"):
+                _song_of_day_cache = on_disk
+        if _song_of_day_cache["date"] == today and _song_of_day_cache["track"]:
+            return {"track": _song_of_day_cache["track"], "cached": True}
+        return await _fetch_song_of_day(today)
+
+# Use search API to find popular tracks (works with Client Credentials)
+# We'll search for a popular artist/genre and get their top tracks
+_SONG_OF_DAY_QUERIES = (
+    "genre:pop year:2024",
+    "genre:hip-hop year:2024",
+    "genre:rock year:2024",
+    "genre:electronic year:2024",
+)
+
+def _song_of_day_seed(today: str) -> int:
+    # md5 rather than hash(): str hashing is salted per process, and every
+    # worker must pick the same song for the same day
+    return int(hashlib.md5(today.encode(), usedforsecurity=False).hexdigest(), 16)
+
+async def _fetch_song_of_day(today: str) -> dict:
+    """Pick today's song from Spotify and store it in memory and on disk"""
     # Fetch fresh song from Spotify Top 50 USA playlist
     access_token = await get_spotify_client_credentials_token()
     if not access_token:
         return {"track": None, "error": "Spotify credentials not configured"}
     
-    # Use search API to find popular tracks (works with Client Credentials)
-    # We'll search for a popular artist/genre and get their top tracks
-    search_queries = [
-        "genre:pop year:2024",
-        "genre:hip-hop year:2024", 
-        "genre:rock year:2024",
-        "genre:electronic year:2024"
-    ]
-    
     # Use today's date to pick which genre to search
-    import hashlib
-    seed = int(hashlib.md5(today.encode()).hexdigest(), 16)
-    query = search_queries[seed % len(search_queries)]
+    seed = _song_of_day_seed(today)
+    query = _SONG_OF_DAY_QUERIES[seed % len(_SONG_OF_DAY_QUERIES)]
     
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            "https://api.spotify.com/v1/search",
-            params={"q": query, "type": "track", "limit": 50, "market": "US"},
-            headers={"Authorization": f"Bearer {access_token}"}
-        )
-        
-        if response.status_code != 200:
-            print(f"Failed to search for tracks: {response.status_code}")
-            return {"track": None, "error": "Failed to fetch song of the day"}
-        
-        data = response.json()
-        items = data.get("tracks", {}).get("items", [])
-        
-        if not items:
-            return {"track": None, "error": "No tracks found"}
-        
-        # Pick a deterministic track based on today's date
-        track_index = seed % len(items)
-        track = items[track_index]
-        
-        if not track:
-            return {"track": None, "error": "Invalid track data"}
-        
-        song_data = {
-            "id": track["id"],
-            "name": track["name"],
-            "artist": track["artists"][0]["name"] if track.get("artists") else "Unknown",
-            "album": track["album"]["name"] if track.get("album") else None,
-            "album_image_url": track["album"]["images"][0]["url"] if track.get("album", {}).get("images") else None,
-            "spotify_uri": track["uri"],
-            "preview_url": track.get("preview_url"),
-        }
-        
-        # Cache for the day and persist to file
-        _song_of_day_cache["track"] = song_data
-        _song_of_day_cache["date"] = today
-        _save_song_of_day_cache(_song_of_day_cache)
-        
-        return {"track": song_data, "cached": False}
+    response = await spotify_get(
+        "https://api.spotify.com/v1/search",
+        access_token,
+        params={"q": query, "type": "track", "limit": 50, "market": "US"}
+    )
+    
+    if response.status_code != 200:
+        print(f"Failed to search for tracks: {response.status_code}")
+        return {"track": None, "error": "Failed to fetch song of the day"}
+    
+    data = orjson.loads(response.content)
+    items = _search_tracks(data)
+    
+    if not items:
+        return {"track": None, "error": "No tracks found"}
+    
+    # Pick a deterministic track based on today's date
+    track_index = seed % len(items)
+    track = items[track_index]
+    
+    if not track:
+        return {"track": None, "error": "Invalid track data"}
+    
+    song_data = _normalize_track(track, include_preview=True)
+    
+    # Cache for the day and persist to file
+    _song_of_day_cache["track"] = song_data
+    _song_of_day_cache["date"] = today
+    # File I/O runs in a worker thread, off the event loop
+    await asyncio.to_thread(_save_song_of_day_cache, dict(_song_of_day_cache))
+    
+    return {"track": song_data, "cached": False}
 
 # Cache for trending songs
 _trending_songs_cache: dict = {"date": None, "genres": []}
@@ -1054,35 +1235,34 @@ async def get_trending_songs():
     
     result_genres = []
     
-    async with httpx.AsyncClient() as client:
-        for genre_name, query in genres_to_search:
-            try:
-                response = await client.get(
-                    "https://api.spotify.com/v1/search",
-                    params={"q": query, "type": "track", "limit": 5, "market": "US"},
-                    headers={"Authorization": f"Bearer {access_token}"}
-                )
+    responses = await asyncio.gather(*(
+        spotify_get(
+            "https://api.spotify.com/v1/search",
+            access_token,
+            params={"q": query, "type": "track", "limit": 5, "market": "US"}
+        )
+        for _, query in genres_to_search
+    ), return_exceptions=True)
+    
+    for (genre_name, _), response in zip(genres_to_search, responses):
+        try:
+            if isinstance(response, Exception):
+                raise response
+            
+            if response.status_code == 200:
+                data = orjson.loads(response.content)
+                tracks = []
+                for track in _search_tracks(data):
+                    tracks.append(_normalize_track(track, include_album=False))
                 
-                if response.status_code == 200:
-                    data = response.json()
-                    tracks = []
-                    for track in data.get("tracks", {}).get("items", []):
-                        tracks.append({
-                            "id": track["id"],
-                            "name": track["name"],
-                            "artist": track["artists"][0]["name"] if track["artists"] else "Unknown",
-                            "album_image_url": track["album"]["images"][0]["url"] if track.get("album", {}).get("images") else None,
-                            "spotify_uri": track["uri"]
-                        })
-                    
-                    if tracks:
-                        result_genres.append({
-                            "genre": genre_name,
-                            "tracks": tracks
-                        })
-            except Exception as e:
-                print(f"Error fetching {genre_name} tracks: {e}")
-                continue
+                if tracks:
+                    result_genres.append({
+                        "genre": genre_name,
+                        "tracks": tracks
+                    })
+        except Exception as e:
+            print(f"Error fetching {genre_name} tracks: {e}")
+            continue
     
     # Cache the results
     _trending_songs_cache["date"] = current_hour
@@ -1101,58 +1281,90 @@ async def get_discover_songs():
         return {"tracks": [], "error": "Spotify credentials not configured"}
     
     # Search for popular/trending tracks
-    async with httpx.AsyncClient() as client:
-        try:
-            # Get a mix of popular tracks from different genres
-            response = await client.get(
-                "https://api.spotify.com/v1/search",
-                params={
-                    "q": "year:2024",
-                    "type": "track",
-                    "limit": 10,
-                    "market": "US"
-                },
-                headers={"Authorization": f"Bearer {access_token}"}
-            )
-            
-            if response.status_code != 200:
-                return {"tracks": [], "error": f"Spotify API error: {response.status_code}"}
-            
-            data = response.json()
-            tracks = []
-            for track in data.get("tracks", {}).get("items", []):
-                tracks.append({
-                    "id": track["id"],
-                    "name": track["name"],
-                    "artist": track["artists"][0]["name"] if track["artists"] else "Unknown",
-                    "album": track["album"]["name"] if track.get("album") else None,
-                    "album_image_url": track["album"]["images"][0]["url"] if track.get("album", {}).get("images") else None,
-                    "spotify_uri": track["uri"],
-                    "preview_url": track.get("preview_url")
-                })
-            
-            return {"tracks": tracks}
-        except Exception as e:
-            print(f"Error fetching discover songs: {e}")
-            return {"tracks": [], "error": str(e)}
+    try:
+        # Get a mix of popular tracks from different genres
+        response = await spotify_get(
+            "https://api.spotify.com/v1/search",
+            access_token,
+            params={
+                "q": "year:2024",
+                "type": "track",
+                "limit": 10,
+                "market": "US"
+            }
+        )
+        
+        if response.status_code != 200:
+            return {"tracks": [], "error": f"Spotify API error: {response.status_code}"}
+        
+        data = orjson.loads(response.content)
+        tracks = []
+        for track in _search_tracks(data):
+            tracks.append(_normalize_track(track, include_preview=True))
+        
+        return {"tracks": tracks}
+    except Exception as e:
+        print(f"Error fetching discover songs: {e}")
+        return {"tracks": [], "error": str(e)}
 
-# Global cache for access tokens: user_id -> (access_token, expiry_timestamp)
-_access_token_cache = {}
+# Global cache for access tokens: user_id -> access_token.
+# Entries expire 5 minutes before Spotify's expires_in (default ~1h).
+ACCESS_TOKEN_EXPIRY_BUFFER = 300
+_access_token_cache = TTLCache(maxsize=10000, ttl=3600 - ACCESS_TOKEN_EXPIRY_BUFFER)
+# user_id -> in-flight refresh task
+_token_refreshes: dict[int, asyncio.Task] = {}
 
-async def get_spotify_access_token(refresh_token: str, user_id: int | None = None, session = None) -> str | None:
+async def get_spotify_access_token(refresh_token: str, user_id: int | None = None) -> str | None:
     """Exchange a refresh token for an access token.
     
     Uses in-memory caching to prevent excessive calls to Spotify.
     """
     # Check cache first if user_id is provided
-    if user_id:
-        cached = _access_token_cache.get(user_id)
-        if cached:
-            token, expiry = cached
-            # Return cached token if it's valid (with 5 min buffer)
-            if datetime.now().timestamp() < expiry - 300:
-                return token
+    if not user_id:
+        return await _refresh_spotify_access_token(refresh_token, user_id)
+    token = _access_token_cache.get(user_id)
+    if token:
+        return token
+    
+    # Concurrent misses for the same user share one refresh POST. The refresh runs
+    # as its own task so a cancelled (disconnected) first caller doesn't abort it.
+    refresh = _token_refreshes.get(user_id)
+    if refresh is None:
+        refresh = asyncio.create_task(_refresh_spotify_access_token(refresh_token, user_id))
+        _token_refreshes[user_id] = refresh
+        
+        def forget(task: asyncio.Task) -> None:
+            # A discarded refresh may already have been replaced by a newer one
+            if _token_refreshes.get(user_id) is task:
+                del _token_refreshes[user_id]
+        refresh.add_done_callback(forget)
+    return await asyncio.shield(refresh)
+
+def discard_spotify_access_token(user_id: int) -> None:
+    """Forget a user's cached access token and any refresh still in flight.
+
+    A discarded refresh still answers the requests already waiting on it, but
+    neither caches its token nor stores a rotated refresh token.
+    """
+    _access_token_cache.pop(user_id)
+    _token_refreshes.pop(user_id, None)
+
+def _save_rotated_refresh_token(user_id: int, old_refresh_token: str, new_refresh_token: str) -> None:
+    # Runs outside any request, so it gets its own session. The WHERE on the old
+    # token keeps a rotation from relinking a user who has just disconnected.
+    with Session(engine) as session:
+        result = session.exec(
+            update(Users)
+            .where(Users.id == user_id, Users.spotify_refresh_token == old_refresh_token)
+            .values(spotify_refresh_token=new_refresh_token)
+        )
+        username = session.exec(select(Users.username).where(Users.id == user_id)).first()
+        session.commit()
+    if result.rowcount:
+        invalidate_cached_user(username)
+        logger.debug("Updated refresh token for user %s", user_id)
 
+async def _refresh_spotify_access_token(refresh_token: str, user_id: int | None) -> str | None:
     spotify_client_id, _ = _get_spotify_client_credentials()
     if not spotify_client_id:
         print("Warning: Spotify Client ID not configured")
@@ -1165,129 +1377,259 @@ async def get_spotify_access_token(refresh_token: str, user_id: int | None = Non
         "client_id": spotify_client_id,
     }
     
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            "https://accounts.spotify.com/api/token",
-            data=data,
-            headers={"Content-Type": "application/x-www-form-urlencoded"}
-        )
-        if response.status_code == 200:
-            resp_data = response.json()
-            access_token = resp_data.get("access_token")
-            expires_in = resp_data.get("expires_in", 3600)
-            
-            # Cache the token
-            if user_id and access_token:
-                expiry = datetime.now().timestamp() + expires_in
-                _access_token_cache[user_id] = (access_token, expiry)
-            
-            # If a new refresh token is returned, update it in DB
-            new_refresh_token = resp_data.get("refresh_token")
-            if new_refresh_token and user_id and session:
-                try:
-                    user = session.get(Users, user_id)
-                    if user:
-                        user.spotify_refresh_token = new_refresh_token
-                        session.add(user)
-                        session.commit()
-                        print(f"Updated refresh token for user {user_id}")
-                except Exception as e:
-                    print(f"Error updating refresh token for user {user_id}: {e}")
-            
-            return access_token
-        else:
-            error_body = response.text
-            print(f"Failed to refresh Spotify token: {response.status_code} - {error_body}")
-            
-            # Note: We do NOT auto-clear tokens here anymore to prevent race conditions
-            # where parallel requests might cause one to fail and wipe the token.
-            
-            return None
+    response = await http_client.post(
+        "https://accounts.spotify.com/api/token",
+        data=data,
+        headers={"Content-Type": "application/x-www-form-urlencoded"}
+    )
+    if response.status_code == 200:
+        resp_data = orjson.loads(response.content)
+        access_token = resp_data.get("access_token")
+        expires_in = resp_data.get("expires_in", 3600)
+        
+        # Only the user's current refresh writes anything back; one discarded by a
+        # disconnect or account deletion just hands its token to its waiters
+        is_current = user_id is not None and _token_refreshes.get(user_id) is asyncio.current_task()
+        
+        # Cache the token
+        if is_current and access_token:
+            ttl = expires_in - ACCESS_TOKEN_EXPIRY_BUFFER
+            if ttl > 0:
+                _access_token_cache.set(user_id, access_token, ttl=ttl)
+        
+        # If a new refresh token is returned, update it in DB
+        new_refresh_token = resp_data.get("refresh_token")
+        if new_refresh_token and is_current:
+            try:
+                await asyncio.to_thread(_save_rotated_refresh_token, user_id, refresh_token, new_refresh_token)
+            except Exception:
+                logger.exception("Error updating refresh token for user %s", user_id)
+        
+        return access_token
+    else:
+        error_body = response.text
+        print(f"Failed to refresh Spotify token: {response.status_code} - {error_body}")
+        
+        # Note: We do NOT auto-clear tokens here anymore to prevent race conditions
+        # where parallel requests might cause one to fail and wipe the token.
+        
+        return None
+
+# Spotify answers bursts with 429 and a Retry-After header (in seconds)
+SPOTIFY_MAX_ATTEMPTS = 3
+SPOTIFY_MAX_RETRY_AFTER = 10.0
+
+async def spotify_get(url: str, access_token: str, params: dict | None = None) -> httpx.Response:
+    """GET a Spotify Web API URL, waiting out rate limiting before giving up"""
+    headers = {"Authorization": f"Bearer {access_token}"}
+    for attempt in range(SPOTIFY_MAX_ATTEMPTS):
+        response = await http_client.get(url, params=params, headers=headers)
+        if response.status_code != 429 or attempt == SPOTIFY_MAX_ATTEMPTS - 1:
+            return response
+        
+        # Honour Retry-After when Spotify sends it, otherwise back off exponentially
+        try:
+            delay = float(response.headers["Retry-After"])
+        except (KeyError, ValueError):
+            delay = 2 ** attempt
+        await asyncio.sleep(min(delay, SPOTIFY_MAX_RETRY_AFTER))
+    return response
+
+async def spotify_get_many(access_token: str, requests: list[tuple[str, dict]]) -> list[httpx.Response]:
+    """GET several Spotify URLs concurrently with one token; responses keep request order"""
+    return await asyncio.gather(*(
+        spotify_get(url, access_token, params) for url, params in requests
+    ))
+
+_TOP_TRACKS_REQUEST = ("https://api.spotify.com/v1/me/top/tracks", {"limit": 5, "time_range": "short_term"})
+_TOP_ARTISTS_REQUEST = ("https://api.spotify.com/v1/me/top/artists", {"limit": 10, "time_range": "medium_term"})
+_RECENTLY_PLAYED_REQUEST = ("https://api.spotify.com/v1/me/player/recently-played", {"limit": 50})
+
+def _top_tracks_result(response: httpx.Response) -> dict:
+    if response.status_code != 200:
+        return {"tracks": [], "error": f"Spotify API error: {response.status_code}"}
+    
+    data = orjson.loads(response.content)
+    tracks = []
+    for item in data.get("items", []):
+        tracks.append(_normalize_track(item))
+    
+    return {"tracks": tracks}
+
+def _top_genres_result(response: httpx.Response) -> dict:
+    if response.status_code != 200:
+        return {"genres": [], "error": f"Spotify API error: {response.status_code}"}
+    
+    data = orjson.loads(response.content)
+    genre_counts: Counter[str] = Counter()
+    
+    for artist in data.get("items", []):
+        genre_counts.update(artist.get("genres", []))
+    
+    # Top 3 by count (a bounded heap, not a full sort); ties keep first-seen order
+    top_genres = [g for g, _ in genre_counts.most_common(3)]
+    
+    return {"genres": top_genres}
+
+def _recent_tracks_result(response: httpx.Response) -> dict:
+    if response.status_code != 200:
+        return {"tracks": [], "error": f"Spotify API error: {response.status_code}"}
+    
+    data = orjson.loads(response.content)
+    tracks: dict[str, dict] = {}  # Keyed by track ID: dedupes and keeps first-played order
+    
+    for item in data.get("items", []):
+        track = item["track"]
+        track_id = track["id"]
+        if track_id in tracks:
+            continue
+        
+        normalized = _normalize_track(track)
+        normalized["played_at"] = item.get("played_at")
+        tracks[track_id] = normalized
+    
+    return {"tracks": list(tracks.values()), "spotify_linked": True}
+
+# Spotify recomputes top tracks/artists daily at most, so a user's parsed results
+# are kept for an hour: (section, user_id) -> payload. Error payloads aren't cached.
+_spotify_stats_cache = TTLCache(maxsize=10000, ttl=3600)
+_SPOTIFY_SECTIONS = {
+    # section: (request, parser, list key), in spotify-profile's key order
+    "top_tracks": (_TOP_TRACKS_REQUEST, _top_tracks_result, "tracks"),
+    "top_genres": (_TOP_ARTISTS_REQUEST, _top_genres_result, "genres"),
+    "recent_tracks": (_RECENTLY_PLAYED_REQUEST, _recent_tracks_result, "tracks"),
+}
+_CACHED_SECTIONS = ("top_tracks", "top_genres", "genre_tracks", "comparison_tracks")
+
+def invalidate_spotify_stats(user_id: int) -> None:
+    """Drop a user's cached Spotify results (on link, disconnect or delete)"""
+    for section in _CACHED_SECTIONS:
+        _spotify_stats_cache.pop((section, user_id))
+
+def _cache_spotify_stats(section: str, user_id: int, result: dict) -> dict:
+    if "error" not in result:
+        _spotify_stats_cache.set((section, user_id), result)
+    return result
+
+def _spotify_stats_response(request: Request, result: dict):
+    """Successful stats go out with an ETag so unchanged polls get a 304"""
+    if "error" in result:
+        return result
+    return etag_response(request, orjson.dumps(result), "private, max-age=60")
+
+async def read_then_release(session: Session, read, *args):
+    """Run `read(session, *args)` in the threadpool, then close the session.
+
+    Async Spotify routes do their DB reads through this: the sync queries stay
+    off the event loop, and the pooled connection goes back before the route
+    awaits Spotify instead of being held through every (rate-limited) call.
+    """
+    def run():
+        try:
+            return read(session, *args)
+        finally:
+            session.close()
+    return await run_in_threadpool(run)
 
 @app.get("/api/users/{user_id}/top-tracks")
-async def get_user_top_tracks(user_id: int, session=Depends(get_session), current_user=Depends(get_current_user)):
+async def get_user_top_tracks(user_id: int, request: Request, session=Depends(get_session), current_user=Depends(get_current_user)):
     """Get a user's top 5 tracks from Spotify"""
-    user = session.get(Users, user_id)
+    user = await read_then_release(session, get_spotify_link, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
     if not user.spotify_refresh_token:
         return {"tracks": [], "error": "User has not linked Spotify", "spotify_linked": False}
     
-    access_token = await get_spotify_access_token(user.spotify_refresh_token, user_id, session)
-    if not access_token:
-        return {"tracks": [], "error": "Spotify access expired - please reconnect", "spotify_linked": False}
-    
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            "https://api.spotify.com/v1/me/top/tracks",
-            params={"limit": 5, "time_range": "short_term"},
-            headers={"Authorization": f"Bearer {access_token}"}
-        )
-        
-        if response.status_code != 200:
-            return {"tracks": [], "error": f"Spotify API error: {response.status_code}"}
-        
-        data = response.json()
-        tracks = []
-        for item in data.get("items", []):
-            tracks.append({
-                "id": item["id"],
-                "name": item["name"],
-                "artist": item["artists"][0]["name"] if item["artists"] else "Unknown",
-                "album": item["album"]["name"] if item.get("album") else None,
-                "album_image_url": item["album"]["images"][0]["url"] if item.get("album", {}).get("images") else None,
-                "spotify_uri": item["uri"]
-            })
+    result = _spotify_stats_cache.get(("top_tracks", user_id))
+    if result is None:
+        access_token = await get_spotify_access_token(user.spotify_refresh_token, user_id)
+        if not access_token:
+            return {"tracks": [], "error": "Spotify access expired - please reconnect", "spotify_linked": False}
         
-        return {"tracks": tracks}
+        [response] = await spotify_get_many(access_token, [_TOP_TRACKS_REQUEST])
+        result = _cache_spotify_stats("top_tracks", user_id, _top_tracks_result(response))
+    return _spotify_stats_response(request, result)
 
 @app.get("/api/users/{user_id}/top-genres")
-async def get_user_top_genres(user_id: int, session=Depends(get_session), current_user=Depends(get_current_user)):
+async def get_user_top_genres(user_id: int, request: Request, session=Depends(get_session), current_user=Depends(get_current_user)):
     """Get a user's top 3 genres from Spotify (based on top artists)"""
-    user = session.get(Users, user_id)
+    user = await read_then_release(session, get_spotify_link, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
     if not user.spotify_refresh_token:
         return {"genres": [], "error": "User has not linked Spotify", "spotify_linked": False}
     
-    access_token = await get_spotify_access_token(user.spotify_refresh_token, user_id, session)
+    result = _spotify_stats_cache.get(("top_genres", user_id))
+    if result is None:
+        access_token = await get_spotify_access_token(user.spotify_refresh_token, user_id)
+        if not access_token:
+            return {"genres": [], "error": "Spotify access expired - please reconnect", "spotify_linked": False}
+        
+        [response] = await spotify_get_many(access_token, [_TOP_ARTISTS_REQUEST])
+        result = _cache_spotify_stats("top_genres", user_id, _top_genres_result(response))
+    return _spotify_stats_response(request, result)
+
+@app.get("/api/users/{user_id}/spotify-profile")
+async def get_user_spotify_profile(user_id: int, session=Depends(get_session), current_user=Depends(get_current_user)):
+    """Top tracks, top genres and (for friends/self) recent tracks in one call.
+
+    Each key holds the same payload as the matching single endpoint; the
+    Spotify requests behind them run concurrently.
+    """
+    def read(session):
+        user = get_spotify_link(session, user_id)
+        return user, user is not None and friendship_status(session, current_user.id, user_id) in ("self", "friend")
+    
+    user, can_see_recent = await read_then_release(session, read)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    if not user.spotify_refresh_token:
+        error = {"error": "User has not linked Spotify", "spotify_linked": False}
+        return {section: {key: [], **error} for section, (_, _, key) in _SPOTIFY_SECTIONS.items()}
+    
+    # Cached top tracks/genres are reused; only the rest goes to Spotify
+    results = {
+        section: _spotify_stats_cache.get((section, user_id))
+        for section in _SPOTIFY_SECTIONS
+    }
+    if not can_see_recent:
+        results["recent_tracks"] = {"tracks": [], "error": "You must be friends to see recent tracks"}
+    missing = [section for section, result in results.items() if result is None]
+    if not missing:
+        return results
+    
+    access_token = await get_spotify_access_token(user.spotify_refresh_token, user_id)
     if not access_token:
-        return {"genres": [], "error": "Spotify access expired - please reconnect", "spotify_linked": False}
+        error = {"error": "Spotify access expired - please reconnect", "spotify_linked": False}
+        for section in missing:
+            results[section] = {_SPOTIFY_SECTIONS[section][2]: [], **error}
+        return results
     
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            "https://api.spotify.com/v1/me/top/artists",
-            params={"limit": 10, "time_range": "medium_term"},
-            headers={"Authorization": f"Bearer {access_token}"}
-        )
-        
-        if response.status_code != 200:
-            return {"genres": [], "error": f"Spotify API error: {response.status_code}"}
-        
-        data = response.json()
-        genre_counts: dict[str, int] = {}
-        
-        for artist in data.get("items", []):
-            for genre in artist.get("genres", []):
-                genre_counts[genre] = genre_counts.get(genre, 0) + 1
-        
-        # Sort by count and take top 3
-        sorted_genres = sorted(genre_counts.items(), key=lambda x: x[1], reverse=True)
-        top_genres = [g[0] for g in sorted_genres[:3]]
-        
-        return {"genres": top_genres}
+    responses = await spotify_get_many(
+        access_token, [_SPOTIFY_SECTIONS[section][0] for section in missing]
+    )
+    for section, response in zip(missing, responses):
+        result = _SPOTIFY_SECTIONS[section][1](response)
+        if section in _CACHED_SECTIONS:
+            _cache_spotify_stats(section, user_id, result)
+        results[section] = result
+    return results
 
 # ============= Spotify Recommendations =============
 
 @app.get("/api/spotify/recommendations")
 async def get_spotify_recommendations(session=Depends(get_session), user=Depends(get_current_user)):
     """Get personalized song recommendations from Spotify based on user's top tracks"""
+    # get_current_user may have queried; hand its connection back before calling Spotify
+    await run_in_threadpool(session.close)
+    
     if not user.spotify_refresh_token:
         return {"tracks": [], "error": "User has not linked Spotify", "spotify_linked": False}
     
-    access_token = await get_spotify_access_token(user.spotify_refresh_token, user.id, session)
+    access_token = await get_spotify_access_token(user.spotify_refresh_token, user.id)
     
     # If user token doesn't work, fall back to client credentials for generic recommendations
     use_fallback = False
@@ -1297,149 +1639,127 @@ async def get_spotify_recommendations(session=Depends(get_session), user=Depends
         if not access_token:
             return {"tracks": [], "error": "Spotify access expired - please reconnect", "spotify_linked": False}
     
-    async with httpx.AsyncClient() as client:
-        seed_tracks = []
+    seed_tracks = []
+    
+    # Only try to get user's top tracks if we have a user token (not fallback mode)
+    if not use_fallback:
+        # First get user's top tracks for seeds
+        top_response = await spotify_get(
+            "https://api.spotify.com/v1/me/top/tracks",
+            access_token,
+            params={"limit": 5, "time_range": "short_term"}
+        )
+        
+        if top_response.status_code == 200:
+            top_data = orjson.loads(top_response.content)
+            seed_tracks = [t["id"] for t in top_data.get("items", [])[:5]]
         
-        # Only try to get user's top tracks if we have a user token (not fallback mode)
-        if not use_fallback:
-            # First get user's top tracks for seeds
-            top_response = await client.get(
+        # If no short-term tracks, try medium-term
+        if not seed_tracks:
+            medium_response = await spotify_get(
                 "https://api.spotify.com/v1/me/top/tracks",
-                params={"limit": 5, "time_range": "short_term"},
-                headers={"Authorization": f"Bearer {access_token}"}
+                access_token,
+                params={"limit": 5, "time_range": "medium_term"}
             )
-            
-            if top_response.status_code == 200:
-                top_data = top_response.json()
-                seed_tracks = [t["id"] for t in top_data.get("items", [])[:5]]
-            
-            # If no short-term tracks, try medium-term
-            if not seed_tracks:
-                medium_response = await client.get(
-                    "https://api.spotify.com/v1/me/top/tracks",
-                    params={"limit": 5, "time_range": "medium_term"},
-                    headers={"Authorization": f"Bearer {access_token}"}
-                )
-                if medium_response.status_code == 200:
-                    medium_data = medium_response.json()
-                    seed_tracks = [t["id"] for t in medium_data.get("items", [])[:5]]
-            
-            # If still no tracks, try long-term
-            if not seed_tracks:
-                long_response = await client.get(
-                    "https://api.spotify.com/v1/me/top/tracks",
-                    params={"limit": 5, "time_range": "long_term"},
-                    headers={"Authorization": f"Bearer {access_token}"}
-                )
-                if long_response.status_code == 200:
-                    long_data = long_response.json()
-                    seed_tracks = [t["id"] for t in long_data.get("items", [])[:5]]
+            if medium_response.status_code == 200:
+                medium_data = orjson.loads(medium_response.content)
+                seed_tracks = [t["id"] for t in medium_data.get("items", [])[:5]]
         
+        # If still no tracks, try long-term
         if not seed_tracks:
-            # Fallback: use search API instead of recommendations (more reliable)
-            # Search for popular tracks in popular genres
-            tracks = []
-            genres_to_search = ["pop", "hip-hop", "rock"]
-            
-            for genre in genres_to_search:
-                search_response = await client.get(
-                    "https://api.spotify.com/v1/search",
-                    params={
-                        "q": f"genre:{genre} year:2024",
-                        "type": "track",
-                        "limit": 4,
-                        "market": "US"
-                    },
-                    headers={"Authorization": f"Bearer {access_token}"}
-                )
-                
-                if search_response.status_code == 200:
-                    search_data = search_response.json()
-                    for track in search_data.get("tracks", {}).get("items", []):
-                        tracks.append({
-                            "id": track["id"],
-                            "name": track["name"],
-                            "artist": track["artists"][0]["name"] if track["artists"] else "Unknown",
-                            "album": track["album"]["name"] if track.get("album") else None,
-                            "album_image_url": track["album"]["images"][0]["url"] if track.get("album", {}).get("images") else None,
-                            "spotify_uri": track["uri"],
-                            "preview_url": track.get("preview_url")
-                        })
-            
-            if tracks:
-                return {"tracks": tracks[:10], "fallback": True}
-            
-            return {"tracks": [], "error": "Could not get recommendations", "no_history": True}
+            long_response = await spotify_get(
+                "https://api.spotify.com/v1/me/top/tracks",
+                access_token,
+                params={"limit": 5, "time_range": "long_term"}
+            )
+            if long_response.status_code == 200:
+                long_data = orjson.loads(long_response.content)
+                seed_tracks = [t["id"] for t in long_data.get("items", [])[:5]]
+    
+    if not seed_tracks:
+        # Fallback: use search API instead of recommendations (more reliable)
+        # Search for popular tracks in popular genres
+        tracks = []
+        genres_to_search = ["pop", "hip-hop", "rock"]
         
-        # Get recommendations based on seed tracks
-        rec_response = await client.get(
-            "https://api.spotify.com/v1/recommendations",
-            params={
-                "seed_tracks": ",".join(seed_tracks[:5]),
-                "limit": 10,
+        search_responses = await spotify_get_many(access_token, [
+            ("https://api.spotify.com/v1/search", {
+                "q": f"genre:{genre} year:2024",
+                "type": "track",
+                "limit": 4,
                 "market": "US"
-            },
-            headers={"Authorization": f"Bearer {access_token}"}
-        )
+            })
+            for genre in genres_to_search
+        ])
+        for search_response in search_responses:
+            if search_response.status_code == 200:
+                search_data = orjson.loads(search_response.content)
+                for track in _search_tracks(search_data):
+                    tracks.append(_normalize_track(track, include_preview=True))
         
-        if rec_response.status_code != 200:
-            # Recommendations API failed - fallback to search API
-            # Get artist names from user's top tracks to use as search seeds
-            tracks = []
-            genres_to_search = ["pop", "hip-hop", "rock", "indie", "electronic"]
-            
-            for genre in genres_to_search[:3]:
-                search_response = await client.get(
-                    "https://api.spotify.com/v1/search",
-                    params={
-                        "q": f"genre:{genre} year:2024-2025",
-                        "type": "track",
-                        "limit": 4,
-                        "market": "US"
-                    },
-                    headers={"Authorization": f"Bearer {access_token}"}
-                )
-                
-                if search_response.status_code == 200:
-                    search_data = search_response.json()
-                    for track in search_data.get("tracks", {}).get("items", []):
-                        tracks.append({
-                            "id": track["id"],
-                            "name": track["name"],
-                            "artist": track["artists"][0]["name"] if track["artists"] else "Unknown",
-                            "album": track["album"]["name"] if track.get("album") else None,
-                            "album_image_url": track["album"]["images"][0]["url"] if track.get("album", {}).get("images") else None,
-                            "spotify_uri": track["uri"],
-                            "preview_url": track.get("preview_url")
-                        })
-            
-            if tracks:
-                return {"tracks": tracks[:10], "fallback": True}
-            
-            return {"tracks": [], "error": f"Spotify API error: {rec_response.status_code}"}
+        if tracks:
+            return {"tracks": tracks[:10], "fallback": True}
         
-        rec_data = rec_response.json()
+        return {"tracks": [], "error": "Could not get recommendations", "no_history": True}
+    
+    # Get recommendations based on seed tracks
+    rec_response = await spotify_get(
+        "https://api.spotify.com/v1/recommendations",
+        access_token,
+        params={
+            "seed_tracks": ",".join(seed_tracks[:5]),
+            "limit": 10,
+            "market": "US"
+        }
+    )
+    
+    if rec_response.status_code != 200:
+        # Recommendations API failed - fallback to search API
+        # Get artist names from user's top tracks to use as search seeds
         tracks = []
-        for track in rec_data.get("tracks", []):
-            tracks.append({
-                "id": track["id"],
-                "name": track["name"],
-                "artist": track["artists"][0]["name"] if track["artists"] else "Unknown",
-                "album": track["album"]["name"] if track.get("album") else None,
-                "album_image_url": track["album"]["images"][0]["url"] if track.get("album", {}).get("images") else None,
-                "spotify_uri": track["uri"],
-                "preview_url": track.get("preview_url")
+        genres_to_search = ["pop", "hip-hop", "rock", "indie", "electronic"]
+        
+        search_responses = await spotify_get_many(access_token, [
+            ("https://api.spotify.com/v1/search", {
+                "q": f"genre:{genre} year:2024-2025",
+                "type": "track",
+                "limit": 4,
+                "market": "US"
             })
+            for genre in genres_to_search[:3]
+        ])
+        for search_response in search_responses:
+            if search_response.status_code == 200:
+                search_data = orjson.loads(search_response.content)
+                for track in _search_tracks(search_data):
+                    tracks.append(_normalize_track(track, include_preview=True))
         
-        return {"tracks": tracks}
+        if tracks:
+            return {"tracks": tracks[:10], "fallback": True}
+        
+        return {"tracks": [], "error": f"Spotify API error: {rec_response.status_code}"}
+    
+    rec_data = orjson.loads(rec_response.content)
+    tracks = []
+    for track in rec_data.get("tracks", []):
+        tracks.append(_normalize_track(track, include_preview=True))
+    
+    return {"tracks": tracks}
 
 @app.get("/api/spotify/genre-tracks")
 async def get_genre_tracks(session=Depends(get_session), user=Depends(get_current_user)):
     """Get popular tracks organized by user's top genres"""
+    # get_current_user may have queried; hand its connection back before calling Spotify
+    await run_in_threadpool(session.close)
+    
     if not user.spotify_refresh_token:
         return {"genres": [], "error": "User has not linked Spotify", "spotify_linked": False}
     
-    access_token = await get_spotify_access_token(user.spotify_refresh_token, user.id, session)
+    cached = _spotify_stats_cache.get(("genre_tracks", user.id))
+    if cached is not None:
+        return cached
+    
+    access_token = await get_spotify_access_token(user.spotify_refresh_token, user.id)
     
     # If user token doesn't work, fall back to client credentials for generic genre tracks
     use_fallback = False
@@ -1449,118 +1769,99 @@ async def get_genre_tracks(session=Depends(get_session), user=Depends(get_curren
         if not access_token:
             return {"genres": [], "error": "Spotify access expired - please reconnect", "spotify_linked": False}
     
-    async with httpx.AsyncClient() as client:
-        sorted_genres = []
-        genre_counts: dict[str, int] = {}
+    sorted_genres = []
+    genre_counts: Counter[str] = Counter()
+    
+    # Only try to get user's top artists if we have a user token (not fallback mode)
+    if not use_fallback:
+        # Get user's top artists to determine genres - try medium term first
+        artists_response = await spotify_get(
+            "https://api.spotify.com/v1/me/top/artists",
+            access_token,
+            params={"limit": 20, "time_range": "medium_term"}
+        )
         
-        # Only try to get user's top artists if we have a user token (not fallback mode)
-        if not use_fallback:
-            # Get user's top artists to determine genres - try medium term first
-            artists_response = await client.get(
+        artists_data = {}
+        if artists_response.status_code == 200:
+            artists_data = orjson.loads(artists_response.content)
+        
+        # If no medium-term artists, try long-term
+        if not artists_data.get("items"):
+            long_response = await spotify_get(
                 "https://api.spotify.com/v1/me/top/artists",
-                params={"limit": 20, "time_range": "medium_term"},
-                headers={"Authorization": f"Bearer {access_token}"}
+                access_token,
+                params={"limit": 20, "time_range": "long_term"}
             )
-            
-            artists_data = {}
-            if artists_response.status_code == 200:
-                artists_data = artists_response.json()
-            
-            # If no medium-term artists, try long-term
-            if not artists_data.get("items"):
-                long_response = await client.get(
-                    "https://api.spotify.com/v1/me/top/artists",
-                    params={"limit": 20, "time_range": "long_term"},
-                    headers={"Authorization": f"Bearer {access_token}"}
-                )
-                if long_response.status_code == 200:
-                    artists_data = long_response.json()
-            
-            # Count genres
-            for artist in artists_data.get("items", []):
-                for genre in artist.get("genres", []):
-                    genre_counts[genre] = genre_counts.get(genre, 0) + 1
-            
-            # Get top 3 genres
-            sorted_genres = sorted(genre_counts.items(), key=lambda x: x[1], reverse=True)[:3]
+            if long_response.status_code == 200:
+                artists_data = orjson.loads(long_response.content)
         
-        # If no user genres or using fallback, use popular fallback genres
-        if not sorted_genres:
-            sorted_genres = [("pop", 1), ("hip hop", 1), ("rock", 1)]
+        # Count genres
+        for artist in artists_data.get("items", []):
+            genre_counts.update(artist.get("genres", []))
         
-        result_genres = []
-        for genre_name, _ in sorted_genres:
-            # Search for tracks in this genre
-            search_response = await client.get(
-                "https://api.spotify.com/v1/search",
-                params={
-                    "q": f"genre:{genre_name}",
-                    "type": "track",
-                    "limit": 5,
-                    "market": "US"
-                },
-                headers={"Authorization": f"Bearer {access_token}"}
-            )
+        # Get top 3 genres
+        sorted_genres = genre_counts.most_common(3)
+    
+    # If no user genres or using fallback, use popular fallback genres
+    if not sorted_genres:
+        sorted_genres = [("pop", 1), ("hip hop", 1), ("rock", 1)]
+    
+    # Search every genre concurrently; a failed search just drops that genre
+    search_responses = await asyncio.gather(*(
+        spotify_get(
+            "https://api.spotify.com/v1/search",
+            access_token,
+            params={
+                "q": f"genre:{genre_name}",
+                "type": "track",
+                "limit": 5,
+                "market": "US"
+            }
+        )
+        for genre_name, _ in sorted_genres
+    ), return_exceptions=True)
+    
+    result_genres = []
+    for (genre_name, _), search_response in zip(sorted_genres, search_responses):
+        if isinstance(search_response, Exception):
+            print(f"Error fetching {genre_name} tracks: {search_response}")
+            continue
+        if search_response.status_code == 200:
+            search_data = orjson.loads(search_response.content)
+            tracks = []
+            for track in _search_tracks(search_data):
+                tracks.append(_normalize_track(track, include_album=False))
             
-            if search_response.status_code == 200:
-                search_data = search_response.json()
-                tracks = []
-                for track in search_data.get("tracks", {}).get("items", []):
-                    tracks.append({
-                        "id": track["id"],
-                        "name": track["name"],
-                        "artist": track["artists"][0]["name"] if track["artists"] else "Unknown",
-                        "album_image_url": track["album"]["images"][0]["url"] if track.get("album", {}).get("images") else None,
-                        "spotify_uri": track["uri"]
-                    })
-                
-                if tracks:
-                    result_genres.append({
-                        "genre": genre_name.title(),
-                        "tracks": tracks
-                    })
-        
-        return {"genres": result_genres, "fallback": len(genre_counts) == 0}
+            if tracks:
+                result_genres.append({
+                    "genre": genre_name.title(),
+                    "tracks": tracks
+                })
+    
+    result = {"genres": result_genres, "fallback": len(genre_counts) == 0}
+    # Only the personalised result is worth keeping; fallback mode retries next time
+    if result_genres and not use_fallback:
+        _cache_spotify_stats("genre_tracks", user.id, result)
+    return result
 
 # ============= Polls =============
 
-@app.get("/api/polls/active")
-async def get_active_polls_endpoint(community_id: int | None = None, session=Depends(get_session)):
+@app.get("/api/polls/active", response_model=list[PollSummaryOut])
+def get_active_polls_endpoint(community_id: int | None = None, session=Depends(get_session)):
     """Get active polls, optionally filtered by community"""
-    polls = get_active_polls(session, community_id)
-    return [{
-        "id": p.id,
-        "community_id": p.community_id,
-        "title": p.title,
-        "description": p.description,
-        "ends_at": p.ends_at.isoformat(),
-        "is_active": p.is_active
-    } for p in polls]
-
-@app.get("/api/polls/{poll_id}")
-async def get_poll(poll_id: int, session=Depends(get_session)):
+    return get_active_polls(session, community_id)
+
+@app.get("/api/polls/{poll_id}", response_model=PollDetailOut)
+def get_poll(poll_id: int, session=Depends(get_session)):
     """Get a specific poll with its options"""
     poll_data = get_poll_with_options(session, poll_id)
     if not poll_data:
         raise HTTPException(status_code=404, detail="Poll not found")
     
-    return {
-        "poll": {
-            "id": poll_data["poll"].id,
-            "title": poll_data["poll"].title,
-            "description": poll_data["poll"].description,
-            "ends_at": poll_data["poll"].ends_at.isoformat()
-        },
-        "options": [{
-            "id": opt.id,
-            "song_name": opt.song_name,
-            "artist_name": opt.artist_name,
-            "votes": opt.votes
-        } for opt in poll_data["options"]]
-    }
+    return poll_data
 
 @app.post("/api/polls/{poll_id}/vote")
-async def vote_on_poll_endpoint(poll_id: int, vote_data: VoteRequest, session=Depends(get_session), user=Depends(get_current_user)):
+def vote_on_poll_endpoint(poll_id: int, vote_data: VoteRequest, session=Depends(get_session), user=Depends(get_current_user)):
     """Vote on a poll"""
     vote = vote_on_poll(session, user.id, poll_id, vote_data.option_id)
     if not vote:
@@ -1577,173 +1878,159 @@ async def generate_weekly_polls(
     """Generate weekly polls based on Spotify data (using user's token)"""
     genres = ["pop", "rock", "hip-hop", "indie", "r-n-b"]
     
-    async with httpx.AsyncClient() as client:
-        for genre in genres:
-            # 1. Search for tracks in this genre
-            try:
-                response = await client.get(
-                    "https://api.spotify.com/v1/search",
-                    params={
-                        "q": f"genre:{genre}",
-                        "type": "track",
-                        "limit": 5,
-                        "market": "US"
-                    },
-                    headers={"Authorization": f"Bearer {token}"}
-                )
-                
-                if response.status_code != 200:
-                    print(f"Failed to fetch for {genre}: {response.status_code}")
-                    continue
-                    
-                data = response.json()
-                tracks = data.get("tracks", {}).get("items", [])
-                
-                if not tracks:
-                    continue
-                    
-                # 2. Find or create a community for this genre
-                statement = select(Community).where(Community.name.ilike(f"%{genre}%"))
-                community = session.exec(statement).first()
-                
-                if not community:
-                    # Create a new community for this genre
-                    community = Community(
-                        name=f"{genre.capitalize()} Fans",
-                        description=f"The place for {genre} lovers.",
-                        icon_name="musical-notes"
-                    )
-                    session.add(community)
-                    session.commit()
-                    session.refresh(community)
-                
-                # 3. Deactivate old polls for this community
-                statement = select(Poll).where(
-                    Poll.community_id == community.id,
-                    Poll.is_active == True
-                )
-                old_polls = session.exec(statement).all()
-                for p in old_polls:
-                    p.is_active = False
-                    session.add(p)
-                
-                # 4. Create new poll
-                new_poll = Poll(
-                    community_id=community.id,
-                    title=f"Weekly {genre.capitalize()} Top Picks",
-                    description=f"Vote for your favorite {genre} track of the week!",
-                    ends_at=datetime.utcnow() + timedelta(days=7),
-                    is_active=True
-                )
-                session.add(new_poll)
-                session.commit()
-                session.refresh(new_poll)
-                
-                # 5. Add options
-                for track in tracks:
-                    option = PollOption(
-                        poll_id=new_poll.id,
-                        song_name=track["name"],
-                        artist_name=track["artists"][0]["name"],
-                        spotify_uri=track["uri"]
-                    )
-                    session.add(option)
-                
-                session.commit()
+    # 1. Search for tracks in every genre at once; the DB writes below stay sequential
+    responses = await asyncio.gather(*(
+        spotify_get(
+            "https://api.spotify.com/v1/search",
+            token,
+            params={
+                "q": f"genre:{genre}",
+                "type": "track",
+                "limit": 5,
+                "market": "US"
+            }
+        )
+        for genre in genres
+    ), return_exceptions=True)
+    
+    # Every poll generated in this run closes at the same moment
+    ends_at = datetime.now(timezone.utc) + timedelta(days=7)
+    for genre, response in zip(genres, responses):
+        try:
+            if isinstance(response, Exception):
+                raise response
+            
+            if response.status_code != 200:
+                print(f"Failed to fetch for {genre}: {response.status_code}")
+                continue
                 
-            except Exception as e:
-                print(f"Error generating poll for {genre}: {e}")
+            data = orjson.loads(response.content)
+            tracks = _search_tracks(data)
+            
+            if not tracks:
                 continue
+                
+            # The DB writes run in the threadpool, off the event loop
+            await run_in_threadpool(_create_genre_poll, session, genre, tracks, ends_at)
             
+        except Exception as e:
+            await run_in_threadpool(session.rollback)
+            print(f"Error generating poll for {genre}: {e}")
+            continue
+        
     return {"message": "Polls generated successfully"}
 
+def _create_genre_poll(session: Session, genre: str, tracks: list[dict], ends_at: datetime) -> None:
+    """Replace a genre community's active poll with one built from `tracks`"""
+    # 2. Find or create a community for this genre
+    statement = select(Community).where(Community.name.ilike(f"%{genre}%"))
+    community = session.exec(statement).first()
+    
+    if not community:
+        # Create a new community for this genre
+        community = Community(
+            name=f"{genre.capitalize()} Fans",
+            description=f"The place for {genre} lovers.",
+            icon_name="musical-notes"
+        )
+        session.add(community)
+        session.commit()
+        session.refresh(community)
+        invalidate_communities_cache()
+    
+    # 3. Deactivate old polls for this community (one UPDATE)
+    session.exec(
+        update(Poll)
+        .where(Poll.community_id == community.id, Poll.is_active == True)
+        .values(is_active=False)
+    )
+    
+    # 4. Create new poll
+    new_poll = Poll(
+        community_id=community.id,
+        title=f"Weekly {genre.capitalize()} Top Picks",
+        description=f"Vote for your favorite {genre} track of the week!",
+        ends_at=ends_at,
+        is_active=True
+    )
+    session.add(new_poll)
+    session.flush()
+    
+    # 5. Add options as one multi-row INSERT, committed with the poll
+    session.exec(insert(PollOption), params=[{
+        "poll_id": new_poll.id,
+        "song_name": track["name"],
+        "artist_name": track["artists"][0]["name"],
+        "spotify_uri": track["uri"]
+    } for track in tracks])
+    
+    session.commit()
+
 # ============= Recent Listening & Mutual Songs =============
 
 @app.get("/api/users/{user_id}/recent-tracks")
 async def get_user_recent_tracks(user_id: int, session=Depends(get_session), current_user=Depends(get_current_user)):
     """Get a user's recently played tracks from Spotify (past week)"""
-    user = session.get(Users, user_id)
+    user, can_see_recent = await read_then_release(session, _recent_tracks_reads, current_user.id, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    # Check friendship for privacy
-    is_friend = False
-    if user_id != current_user.id:
-        friend_check = session.exec(
-            select(Friendship).where(
-                Friendship.user_id == current_user.id,
-                Friendship.friend_id == user_id,
-                Friendship.status == "accepted"
-            )
-        ).first()
-        is_friend = friend_check is not None
-    
-    is_self = user_id == current_user.id
-    
+    return await _recent_tracks(user, can_see_recent)
+
+def _recent_tracks_reads(session: Session, viewer_id: int, user_id: int):
+    """(Spotify link row or None, whether viewer_id may see the user's recent tracks)"""
+    user = get_spotify_link(session, user_id)
     # Only friends or self can see recent tracks
-    if not is_self and not is_friend:
+    return user, user is not None and friendship_status(session, viewer_id, user_id) in ("self", "friend")
+
+async def _recent_tracks(user, can_see_recent: bool) -> dict:
+    if not can_see_recent:
         return {"tracks": [], "error": "You must be friends to see recent tracks"}
     
     if not user.spotify_refresh_token:
         return {"tracks": [], "error": "User has not linked Spotify", "spotify_linked": False}
     
-    access_token = await get_spotify_access_token(user.spotify_refresh_token, user_id, session)
+    access_token = await get_spotify_access_token(user.spotify_refresh_token, user.id)
     if not access_token:
-        print(f"Failed to get Spotify access token for user {user_id} in recent-tracks")
+        print(f"Failed to get Spotify access token for user {user.id} in recent-tracks")
         return {"tracks": [], "error": "Spotify access expired - please reconnect", "spotify_linked": False}
     
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            "https://api.spotify.com/v1/me/player/recently-played",
-            params={"limit": 50},
-            headers={"Authorization": f"Bearer {access_token}"}
-        )
-        
-        if response.status_code != 200:
-            return {"tracks": [], "error": f"Spotify API error: {response.status_code}"}
-        
-        data = response.json()
-        tracks = []
-        seen_ids = set()  # Dedupe by track ID
-        
-        for item in data.get("items", []):
-            track = item.get("track", {})
-            if track["id"] in seen_ids:
-                continue
-            seen_ids.add(track["id"])
-            
-            tracks.append({
-                "id": track["id"],
-                "name": track["name"],
-                "artist": track["artists"][0]["name"] if track["artists"] else "Unknown",
-                "album": track["album"]["name"] if track.get("album") else None,
-                "album_image_url": track["album"]["images"][0]["url"] if track.get("album", {}).get("images") else None,
-                "spotify_uri": track["uri"],
-                "played_at": item.get("played_at")
-            })
-        
-        return {"tracks": tracks, "spotify_linked": True}
+    [response] = await spotify_get_many(access_token, [_RECENTLY_PLAYED_REQUEST])
+    return _recent_tracks_result(response)
+
+@app.get("/api/users/{user_id}/spotify-snapshot")
+async def get_user_spotify_snapshot(user_id: int, session=Depends(get_session), current_user=Depends(get_current_user)):
+    """Recently played and currently playing for a friend card in one call.
+
+    Each key holds the same payload as the matching single endpoint; both
+    Spotify requests run concurrently.
+    """
+    user, can_see_recent = await read_then_release(session, _recent_tracks_reads, current_user.id, user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    recently_played, currently_playing = await asyncio.gather(
+        _recent_tracks(user, can_see_recent),
+        _currently_playing(user),
+    )
+    return {"recently_played": recently_played, "currently_playing": currently_playing}
 
 @app.get("/api/users/{user_id}/mutual-songs")
 async def get_mutual_songs(user_id: int, session=Depends(get_session), current_user=Depends(get_current_user)):
-    """Get mutual recently played songs between current user and another user"""
+    """Get mutual top songs between current user and another user"""
     if user_id == current_user.id:
         return {"mutual_tracks": [], "error": "Cannot compare with yourself"}
     
-    user = session.get(Users, user_id)
+    def read(session):
+        user = get_spotify_link(session, user_id)
+        return user, user is not None and friendship_status(session, current_user.id, user_id) == "friend"
+    
+    user, is_friend = await read_then_release(session, read)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
     # Check friendship
-    friend_check = session.exec(
-        select(Friendship).where(
-            Friendship.user_id == current_user.id,
-            Friendship.friend_id == user_id,
-            Friendship.status == "accepted"
-        )
-    ).first()
-    
-    if not friend_check:
+    if not is_friend:
         return {"mutual_tracks": [], "error": "You must be friends to compare listening"}
     
     # Check both users have Spotify linked
@@ -1753,68 +2040,130 @@ async def get_mutual_songs(user_id: int, session=Depends(get_session), current_u
     if not user.spotify_refresh_token:
         return {"mutual_tracks": [], "error": "Friend hasn't linked their Spotify", "spotify_linked": False}
     
-    # Get both users' access tokens
-    my_token = await get_spotify_access_token(current_user.spotify_refresh_token, current_user.id, session)
-    their_token = await get_spotify_access_token(user.spotify_refresh_token, user_id, session)
+    # Both users' top tracks, from cache where possible (independent, so fetched concurrently)
+    mine, theirs = await asyncio.gather(
+        _comparison_tracks(current_user.id, current_user.spotify_refresh_token),
+        _comparison_tracks(user_id, user.spotify_refresh_token),
+    )
     
-    if not my_token or not their_token:
-        error_msg = "Your Spotify access expired" if not my_token else "Friend's Spotify access expired"
+    if mine.get("spotify_linked") is False or theirs.get("spotify_linked") is False:
+        error_msg = "Your Spotify access expired" if mine.get("spotify_linked") is False else "Friend's Spotify access expired"
         return {"mutual_tracks": [], "error": error_msg, "spotify_linked": False}
     
-    async with httpx.AsyncClient() as client:
-        # Fetch both users' recently played tracks
-        my_response, their_response = await asyncio.gather(
-            client.get(
-                "https://api.spotify.com/v1/me/player/recently-played",
-                params={"limit": 50},
-                headers={"Authorization": f"Bearer {my_token}"}
-            ),
-            client.get(
-                "https://api.spotify.com/v1/me/player/recently-played",
-                params={"limit": 50},
-                headers={"Authorization": f"Bearer {their_token}"}
-            )
-        )
-        
-        if my_response.status_code != 200 or their_response.status_code != 200:
-            return {"mutual_tracks": [], "error": "Failed to fetch listening history"}
-        
-        my_data = my_response.json()
-        their_data = their_response.json()
-        
-        # Build set of my track IDs
-        my_track_ids = set()
-        my_tracks_map = {}
-        for item in my_data.get("items", []):
-            track = item.get("track", {})
-            my_track_ids.add(track["id"])
-            my_tracks_map[track["id"]] = track
-        
-        # Find mutual tracks
-        mutual_tracks = []
-        seen_ids = set()
-        for item in their_data.get("items", []):
-            track = item.get("track", {})
-            if track["id"] in my_track_ids and track["id"] not in seen_ids:
-                seen_ids.add(track["id"])
-                mutual_tracks.append({
-                    "id": track["id"],
-                    "name": track["name"],
-                    "artist": track["artists"][0]["name"] if track["artists"] else "Unknown",
-                    "album": track["album"]["name"] if track.get("album") else None,
-                    "album_image_url": track["album"]["images"][0]["url"] if track.get("album", {}).get("images") else None,
-                    "spotify_uri": track["uri"]
-                })
+    if "error" in mine or "error" in theirs:
+        return {"mutual_tracks": [], "error": "Failed to fetch listening history"}
+    
+    my_track_ids = {track["id"] for track in mine["tracks"]}
+    # Returning the response directly skips FastAPI's jsonable_encoder walk over the list
+    return ORJSONResponse({"mutual_tracks": _mutual_tracks(my_track_ids, theirs["tracks"])})
+
+# Mutual songs compare medium-term top tracks: unlike the 50 most recent
+# plays they are stable, so they overlap more and cache for the full hour
+_COMPARISON_TRACKS_REQUEST = ("https://api.spotify.com/v1/me/top/tracks", {"limit": 50, "time_range": "medium_term"})
+
+async def _comparison_tracks(user_id: int, refresh_token: str) -> dict:
+    """A user's normalized top tracks for mutual-song comparisons"""
+    result = _spotify_stats_cache.get(("comparison_tracks", user_id))
+    if result is None:
+        access_token = await get_spotify_access_token(refresh_token, user_id)
+        if not access_token:
+            return {"tracks": [], "error": "Spotify access expired", "spotify_linked": False}
         
-        return {"mutual_tracks": mutual_tracks}
+        [response] = await spotify_get_many(access_token, [_COMPARISON_TRACKS_REQUEST])
+        result = _cache_spotify_stats("comparison_tracks", user_id, _top_tracks_result(response))
+    return result
+
+def _mutual_tracks(my_track_ids: set[str], their_tracks: list[dict]) -> list[dict]:
+    """Their tracks that are also in my_track_ids, in their order"""
+    return [track for track in their_tracks if track["id"] in my_track_ids]
+
+# Concurrent Spotify requests per /api/friends/mutual-tracks call
+MUTUAL_TRACKS_CONCURRENCY = 8
+# Friend counts above this build the response in a worker thread
+MUTUAL_TRACKS_INLINE_FRIENDS = 4
+
+@app.get("/api/friends/mutual-tracks")
+async def get_friends_mutual_tracks(session=Depends(get_session), current_user=Depends(get_current_user)):
+    """Mutual top songs with every Spotify-linked friend at once"""
+    if not current_user.spotify_refresh_token:
+        return {"friends": [], "error": "You haven't linked your Spotify", "spotify_linked": False}
+    
+    # The friend-list join runs first, so the session is closed by the first Spotify await
+    friends = await read_then_release(session, get_spotify_linked_friends, current_user.id)
+    
+    mine = await _comparison_tracks(current_user.id, current_user.spotify_refresh_token)
+    if mine.get("spotify_linked") is False:
+        return {"friends": [], "error": "Your Spotify access expired", "spotify_linked": False}
+    if "error" in mine:
+        return {"friends": [], "error": "Failed to fetch listening history"}
+    my_track_ids = {track["id"] for track in mine["tracks"]}
+    
+    semaphore = asyncio.Semaphore(MUTUAL_TRACKS_CONCURRENCY)
+    
+    async def comparison_tracks(friend) -> dict:
+        # Token refresh and fetch share one slot, bounding calls to Spotify
+        async with semaphore:
+            return await _comparison_tracks(friend.id, friend.spotify_refresh_token)
+    
+    their_results = await asyncio.gather(*(comparison_tracks(friend) for friend in friends))
+    
+    # Intersecting many friends' lists is CPU work; past a handful, keep it off the event loop
+    if len(friends) > MUTUAL_TRACKS_INLINE_FRIENDS:
+        results = await asyncio.to_thread(_friends_mutual_tracks, my_track_ids, friends, their_results)
+    else:
+        results = _friends_mutual_tracks(my_track_ids, friends, their_results)
+    
+    return ORJSONResponse({"friends": results})
+
+def _friends_mutual_tracks(my_track_ids: set[str], friends, their_results: list[dict]) -> list[dict]:
+    """One response row per friend with at least one mutual track, in friend order"""
+    results = []
+    for friend, theirs in zip(friends, their_results):
+        if "error" in theirs:
+            continue
+        mutual = _mutual_tracks(my_track_ids, theirs["tracks"])
+        if mutual:
+            results.append({
+                "user": {
+                    "id": friend.id,
+                    "username": friend.username,
+                    "spotify_display_name": friend.spotify_display_name,
+                    "spotify_profile_image_url": friend.spotify_profile_image_url
+                },
+                "mutual_tracks": mutual
+            })
+    return results
+
+# Friends' cards poll this endpoint, so each user's Spotify answer is reused
+# for a few seconds: user_id -> (result, time.monotonic() when fetched)
+CURRENTLY_PLAYING_TTL = 8
+_currently_playing_cache = TTLCache(maxsize=10000, ttl=CURRENTLY_PLAYING_TTL)
+
+# Clients poll this, so the ETag only changes on a new track or every 10s of progress
+CURRENTLY_PLAYING_CACHE_CONTROL = "private, no-cache"
+CURRENTLY_PLAYING_PROGRESS_BUCKET_MS = 10_000
 
 @app.get("/api/users/{user_id}/currently-playing")
-async def get_user_currently_playing(user_id: int, session=Depends(get_session), current_user=Depends(get_current_user)):
+async def get_user_currently_playing(user_id: int, request: Request, session=Depends(get_session), current_user=Depends(get_current_user)):
     """Get what a user is currently playing on Spotify"""
-    user = session.get(Users, user_id)
+    user = await read_then_release(session, get_spotify_link, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
+    result = await _currently_playing(user)
+    if "error" in result:
+        return result
+    
+    etag = None
+    if result["is_playing"]:
+        track = result["track"]
+        progress_bucket = (track["progress_ms"] or 0) // CURRENTLY_PLAYING_PROGRESS_BUCKET_MS
+        etag = f'W/"playing-{track["id"]}-{progress_bucket}"'
+    return etag_response(request, orjson.dumps(result), CURRENTLY_PLAYING_CACHE_CONTROL, etag)
+
+async def _currently_playing(user) -> dict:
+    user_id = user.id
+    
     # Check if user allows showing listening activity
     if not user.show_listening_activity:
         return {"is_playing": False, "message": "User has disabled listening activity"}
@@ -1822,47 +2171,64 @@ async def get_user_currently_playing(user_id: int, session=Depends(get_session),
     if not user.spotify_refresh_token:
         return {"is_playing": False, "spotify_linked": False}
     
-    access_token = await get_spotify_access_token(user.spotify_refresh_token, user_id, session)
+    cached = _currently_playing_cache.get(user_id)
+    if cached is not None:
+        result, fetched_at = cached
+        if result["is_playing"]:
+            # Advance the cached position so the UI keeps ticking between fetches
+            track = dict(result["track"])
+            elapsed_ms = int((time.monotonic() - fetched_at) * 1000)
+            if track["progress_ms"] is not None:
+                track["progress_ms"] += elapsed_ms
+                if track["duration_ms"] is not None:
+                    track["progress_ms"] = min(track["progress_ms"], track["duration_ms"])
+            result = {"is_playing": True, "track": track}
+        return result
+    
+    access_token = await get_spotify_access_token(user.spotify_refresh_token, user_id)
     if not access_token:
         return {"is_playing": False, "error": "Spotify access expired", "spotify_linked": False}
     
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            "https://api.spotify.com/v1/me/player/currently-playing",
-            headers={"Authorization": f"Bearer {access_token}"}
-        )
-        
-        if response.status_code == 204:
-            # Not playing anything
-            return {"is_playing": False}
-        
-        if response.status_code != 200:
-            return {"is_playing": False, "error": f"Spotify API error: {response.status_code}"}
-        
-        data = response.json()
-        
-        if not data.get("is_playing"):
-            return {"is_playing": False}
-        
-        track = data.get("item", {})
-        if not track:
-            return {"is_playing": False}
-        
-        return {
-            "is_playing": True,
-            "track": {
-                "id": track.get("id"),
-                "name": track.get("name"),
-                "artist": track["artists"][0]["name"] if track.get("artists") else "Unknown",
-                "album": track["album"]["name"] if track.get("album") else None,
-                "album_image_url": track["album"]["images"][0]["url"] if track.get("album", {}).get("images") else None,
-                "spotify_uri": track.get("uri"),
-                "progress_ms": data.get("progress_ms"),
-                "duration_ms": track.get("duration_ms")
-            }
+    fetched_at = time.monotonic()
+    result = await _fetch_currently_playing(access_token)
+    if "error" not in result:
+        _currently_playing_cache.set(user_id, (result, fetched_at))
+    return result
+
+async def _fetch_currently_playing(access_token: str) -> dict:
+    response = await spotify_get(
+        "https://api.spotify.com/v1/me/player/currently-playing",
+        access_token
+    )
+    
+    if response.status_code == 204:
+        # Not playing anything
+        return {"is_playing": False}
+    
+    if response.status_code != 200:
+        return {"is_playing": False, "error": f"Spotify API error: {response.status_code}"}
+    
+    data = orjson.loads(response.content)
+    
+    if not data.get("is_playing"):
+        return {"is_playing": False}
+    
+    track = data.get("item")
+    if not track:
+        return {"is_playing": False}
+    
+    return {
+        "is_playing": True,
+        "track": {
+            **_normalize_track(track),
+            "progress_ms": data.get("progress_ms"),
+            "duration_ms": track.get("duration_ms")
         }
+    }
 
 if __name__ == "__main__":
+    if WORKERS > 1:
+        raise SystemExit(MULTI_WORKER_ERROR.format(WORKERS))
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
 
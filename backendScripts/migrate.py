@@ -0,0 +1,101 @@
+"""
+Schema upgrades for databases that create_all built from older models.
+
+create_all only creates missing tables, so keys added to an existing model
+never reach a database that already has the table. Run after updating:
+
+    python -m backendScripts.migrate
+
+Each step checks the live schema first, so running it again is a no-op.
+"""
+from sqlalchemy import func, inspect, text, update
+from sqlmodel import Session, select
+
+from backendScripts.database import (
+    Community, CommunityMembership, Friendship, PollOption, PollVote, create_db_and_tables, engine,
+)
+
+
+def _drop_poll_vote(session: Session, vote: PollVote) -> None:
+    # Each duplicate row was counted when it was inserted
+    session.exec(
+        update(PollOption)
+        .where(PollOption.id == vote.option_id, PollOption.votes > 0)
+        .values(votes=PollOption.votes - 1)
+    )
+
+
+def _drop_membership(session: Session, membership: CommunityMembership) -> None:
+    # Each duplicate join bumped member_count
+    session.exec(
+        update(Community)
+        .where(Community.id == membership.community_id, Community.member_count > 0)
+        .values(member_count=Community.member_count - 1)
+    )
+
+
+# (model, columns, called for each duplicate row before it is deleted, if anything)
+_UNIQUE_KEYS = [
+    (PollVote, ("poll_id", "user_id"), _drop_poll_vote),
+    (Friendship, ("user_id", "friend_id"), None),
+    (CommunityMembership, ("user_id", "community_id"), _drop_membership),
+]
+# (model, index name, columns) for plain lookup indexes
+_INDEXES = [
+    (Friendship, "ix_friendship_user_status", ("user_id", "status")),
+]
+
+
+def _has_unique(inspector, table: str, columns: tuple[str, ...]) -> bool:
+    wanted = set(columns)
+    if any(set(c["column_names"]) == wanted for c in inspector.get_unique_constraints(table)):
+        return True
+    # MySQL and SQLite can report a UNIQUE key as a unique index instead
+    return any(ix["unique"] and set(ix["column_names"]) == wanted for ix in inspector.get_indexes(table))
+
+
+def pending_upgrades() -> list[str]:
+    """Unique keys the models declare but the database is missing, as "table(columns)" """
+    inspector = inspect(engine)
+    return [
+        f"{model.__tablename__}({', '.join(columns)})"
+        for model, columns, _ in _UNIQUE_KEYS
+        if inspector.has_table(model.__tablename__)
+        and not _has_unique(inspector, model.__tablename__, columns)
+    ]
+
+
+def upgrade() -> None:
+    create_db_and_tables()
+    inspector = inspect(engine)
+    with Session(engine) as session:
+        for model, columns, on_duplicate in _UNIQUE_KEYS:
+            table = model.__tablename__
+            if _has_unique(inspector, table, columns):
+                continue
+
+            # Keep the newest row per key; older ones are what the missing key let through
+            newest = select(func.max(model.id)).group_by(*(getattr(model, c) for c in columns))
+            duplicates = session.exec(select(model).where(model.id.not_in(newest))).all()
+            for row in duplicates:
+                if on_duplicate:
+                    on_duplicate(session, row)
+                session.delete(row)
+            session.commit()
+
+            name = f"uq_{table}_{'_'.join(columns)}"
+            with engine.begin() as conn:
+                conn.execute(text(f"CREATE UNIQUE INDEX {name} ON {table} ({', '.join(columns)})"))
+            print(f"✅ Added UNIQUE {table}({', '.join(columns)}), removed {len(duplicates)} duplicate rows")
+
+    for model, name, columns in _INDEXES:
+        table = model.__tablename__
+        if any(ix["name"] == name for ix in inspector.get_indexes(table)):
+            continue
+        with engine.begin() as conn:
+            conn.execute(text(f"CREATE INDEX {name} ON {table} ({', '.join(columns)})"))
+        print(f"✅ Added index {name}")
+
+
+if __name__ == "__main__":
+    upgrade()
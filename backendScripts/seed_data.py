@@ -3,8 +3,8 @@ Seed script to populate database with sample data for testing
 Run this after the database is created to add sample communities and polls
 """
 import os
-from datetime import datetime, timedelta
-from sqlmodel import Session
+from datetime import datetime, timedelta, timezone
+from sqlmodel import Session, select
 from backendScripts.database import (
     engine, Community, Poll, PollOption, 
     create_db_and_tables
@@ -53,7 +53,7 @@ def seed_polls(communities):
         community_id=indie_community.id,
         title="Best Indie Album of the Year?",
         description="Vote for your favorite indie album released this year!",
-        ends_at=datetime.utcnow() + timedelta(days=3),
+        ends_at=datetime.now(timezone.utc) + timedelta(days=3),
         is_active=True
     )
     
@@ -99,38 +99,26 @@ def run_seed():
     create_db_and_tables()
     
     with Session(engine) as session:
-        # Check if communities already exist
-        from sqlmodel import select
-        existing_communities = session.exec(select(Community)).all()
-        if len(existing_communities) > 0:
+        # Any community means the seed already ran; no need to load them all
+        if session.exec(select(Community.id).limit(1)).first() is not None:
             print("✅ Database already seeded, skipping...")
-            print(f"Found {len(existing_communities)} existing communities")
             return
         
+        # Everything goes in one transaction; flush() assigns the IDs the
+        # next batch needs without committing
         print("Seeding communities...")
         communities = seed_communities()
-        for community in communities:
-            session.add(community)
-        session.commit()
-        
-        # Refresh to get IDs
-        for community in communities:
-            session.refresh(community)
+        session.add_all(communities)
+        session.flush()
         
         print("Seeding polls...")
         polls = seed_polls(communities)
-        for poll in polls:
-            session.add(poll)
-        session.commit()
-        
-        # Refresh to get poll IDs
-        for poll in polls:
-            session.refresh(poll)
+        session.add_all(polls)
+        session.flush()
         
         print("Seeding poll options...")
         options = seed_poll_options(polls)
-        for option in options:
-            session.add(option)
+        session.add_all(options)
         session.commit()
         
         print("✅ Database seeded successfully!")
@@ -69,6 +69,10 @@ if [ -f "backendScripts/.env" ]; then
 fi
 
 # Run database migrations and seed
+echo ""
+echo "🔧 Upgrading database schema..."
+python3 -m backendScripts.migrate
+
 echo ""
 echo "🌱 Seeding database with sample data..."
 python3 -m backendScripts.seed_data